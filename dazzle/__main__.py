@@ -1,11 +1,52 @@
 import argparse
 
-from dazzle.task import find_tasks, job_manager
+from dazzle.task import find_tasks, job_manager, JobFailed
+from dazzle.state import host_state
+from dazzle.sshpool import ssh_pool
+from dazzle.ready import ready_listener
+from dazzle.buildcache import build_cache
 
 
 
 parser = argparse.ArgumentParser()
 
+parser.add_argument('--state-ttl',
+                    dest = 'state_ttl',
+                    metavar = 'SECONDS',
+                    default = host_state.ttl,
+                    type = float,
+                    help = 'the time to trust the last known state of a host')
+
+parser.add_argument('--ssh-limit',
+                    dest = 'ssh_limit',
+                    metavar = 'N',
+                    default = ssh_pool.limit,
+                    type = int,
+                    help = 'the maximum number of pooled ssh connections')
+
+parser.add_argument('--ssh-idle',
+                    dest = 'ssh_idle',
+                    metavar = 'SECONDS',
+                    default = ssh_pool.idle,
+                    type = int,
+                    help = 'the time to keep idle pooled ssh connections open')
+
+parser.add_argument('--ready-port',
+                    dest = 'ready_port',
+                    metavar = 'PORT',
+                    default = ready_listener.port,
+                    type = int,
+                    help = 'the UDP port to receive announcements of booted '
+                           'maintenance images on - 0 disables them')
+
+parser.add_argument('--build-cache-size',
+                    dest = 'build_cache_size',
+                    metavar = 'BYTES',
+                    default = build_cache.limit,
+                    type = int,
+                    help = 'the size to limit the cache of built components '
+                           'to - 0 disables the cache')
+
 subparsers = parser.add_subparsers(title = 'tasks',
                                    help = 'the task to execute')
 
@@ -30,13 +71,27 @@ for task in find_tasks(entry_point_group = 'dazzle.tasks'):
 def main():
   args = parser.parse_args()
 
+  host_state.ttl = args.state_ttl
+
+  ssh_pool.limit = args.ssh_limit
+  ssh_pool.idle = args.ssh_idle
+
+  ready_listener.port = args.ready_port
+
+  build_cache.limit = args.build_cache_size
+
   task_args = {name : getattr(args, name)
                for name
                in args.task_args}
 
   task = args.task(parent = job_manager.root,
                    **task_args)
-  task()
+
+  try:
+    task()
+
+  except JobFailed:
+    job_manager.abort()
 
 
 
@@ -0,0 +1,164 @@
+import os
+import shutil
+import logging
+import threading
+
+import sh
+
+from dazzle.utils import cachepath, mkpath
+
+
+
+def tree_size(path):
+  size = 0
+
+  for root, dirs, files in os.walk(path):
+    for name in files:
+      size += os.lstat(mkpath(root, name)).st_size
+
+  return size
+
+
+
+class BuildCache(object):
+  def __init__(self,
+               path = None,
+               limit = 8 * 1024 ** 3):
+    self.__path = path
+    self.__limit = limit
+
+    self.__lock = threading.Lock()
+
+
+  @property
+  def path(self):
+    if self.__path is None:
+      self.__path = os.path.dirname(cachepath('builds', 'x'))
+
+    return self.__path
+
+
+  @property
+  def limit(self):
+    return self.__limit
+
+
+  @limit.setter
+  def limit(self, value):
+    self.__limit = value
+
+
+  @property
+  def enabled(self):
+    return bool(self.limit)
+
+
+  def __entry(self, project, key):
+    return mkpath(self.path, '%s-%s' % (project, key))
+
+
+  def lookup(self, project, key):
+    # Returns the directory of the cached artifact or None - a hit marks the
+    # artifact as recently used
+    if not self.enabled:
+      return None
+
+    entry = self.__entry(project, key)
+
+    if not os.path.isdir(entry):
+      return None
+
+    os.utime(entry, None)
+
+    return entry
+
+
+  def store(self, project, key, trees):
+    # Copies the given trees (name to directory or file) into a new artifact -
+    # the artifact is assembled aside and renamed to never expose partial
+    # copies
+    if not self.enabled:
+      return None
+
+    entry = self.__entry(project, key)
+    temp = '%s.%d' % (entry, os.getpid())
+
+    try:
+      os.mkdir(temp)
+
+      for name, tree in trees.iteritems():
+        if not os.path.isdir(os.path.dirname(mkpath(temp, name))):
+          os.makedirs(os.path.dirname(mkpath(temp, name)))
+
+        sh.cp('-a', '--reflink=auto',
+              tree,
+              mkpath(temp, name))
+
+      with open(mkpath(temp, '.size'), 'w') as f:
+        f.write(str(tree_size(temp)))
+
+      try:
+        os.rename(temp, entry)
+
+      except OSError:
+        # Stored concurrently by another invocation
+        if not os.path.isdir(entry):
+          raise
+
+    finally:
+      shutil.rmtree(temp, ignore_errors = True)
+
+    self.evict()
+
+    return entry
+
+
+  def restore(self, entry, name, target):
+    # Copies a tree or a file of the artifact to the target
+    source = mkpath(entry, name)
+
+    if os.path.isdir(source):
+      sh.cp('-a', '--reflink=auto',
+            '%s/.' % source,
+            target)
+
+    elif os.path.isfile(source):
+      if not os.path.isdir(os.path.dirname(target)):
+        os.makedirs(os.path.dirname(target))
+
+      sh.cp('-a', '--reflink=auto',
+            source,
+            target)
+
+
+  def evict(self):
+    # Removes the least recently used artifacts until the cache fits the limit
+    with self.__lock:
+      entries = []
+
+      for name in os.listdir(self.path):
+        entry = mkpath(self.path, name)
+
+        try:
+          with open(mkpath(entry, '.size'), 'r') as f:
+            size = int(f.read())
+
+        except (IOError, ValueError):
+          continue
+
+        entries.append((os.stat(entry).st_mtime, size, entry))
+
+      total = sum(size for _, size, _ in entries)
+
+      for _, size, entry in sorted(entries):
+        if total <= self.limit:
+          break
+
+        logging.debug('Evicting build artifact: %s', entry)
+
+        shutil.rmtree(entry, ignore_errors = True)
+        total -= size
+
+
+
+build_cache = BuildCache.instance = BuildCache()
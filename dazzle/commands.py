@@ -9,11 +9,6 @@ from sh import (
   ln
 )
 
-try:
-  from sh import etherwake
-except:
-  from sh import ether_wake as etherwake
-
 from shutil import (
   rmtree
 )
@@ -34,7 +29,7 @@ ln = ln.bake('-f')
 
 def cp_script(src, dst):
   cp(src, dst)
-  sh.chmod('+x', src)
+  sh.chmod('+x', dst)
 
 
 
@@ -0,0 +1,228 @@
+import os
+import stat
+import gzip
+import subprocess
+import contextlib
+
+
+
+TRAILER = 'TRAILER!!!'
+
+
+
+def pad(length):
+  return '\0' * (-length % 4)
+
+
+
+class NewcWriter(object):
+  # Writes archives in the SVR4 newc format as read by the kernel. Ownership
+  # and timestamps are normalized and inodes are numbered in archive order to
+  # make the archive depend on the content of the tree only
+
+  def __init__(self, stream, mtime = 0):
+    self.__stream = stream
+    self.__mtime = mtime
+
+    self.__inodes = {}
+
+
+  def __inode(self, key):
+    if key not in self.__inodes:
+      self.__inodes[key] = len(self.__inodes) + 1
+
+    return self.__inodes[key]
+
+
+  def __entry(self, name, ino, mode, nlink, size, rdev = (0, 0)):
+    name = name + '\0'
+
+    header = '070701%08X%08X%08X%08X%08X%08X%08X%08X%08X%08X%08X%08X%08X' % (
+        ino,
+        mode,
+        0, 0,
+        nlink,
+        self.__mtime,
+        size,
+        0, 0,
+        rdev[0], rdev[1],
+        len(name),
+        0)
+
+    self.__stream.write(header + name + pad(len(header) + len(name)))
+
+
+  def __data(self, data):
+    self.__stream.write(data)
+    self.__stream.write(pad(len(data)))
+
+
+  def __copy(self, path, size):
+    with open(path, 'rb') as f:
+      for chunk in iter(lambda: f.read(1024 * 1024), ''):
+        self.__stream.write(chunk)
+
+    self.__stream.write(pad(size))
+
+
+  def device(self, name, major, minor, mode = 0644):
+    self.__entry(name,
+                 ino = self.__inode(('device', name)),
+                 mode = stat.S_IFCHR | mode,
+                 nlink = 1,
+                 size = 0,
+                 rdev = (major, minor))
+
+
+  def tree(self, root, exclude = ()):
+    # Collect the tree first to know the last link of each hardlinked file -
+    # the content is written with the last link only
+    entries = []
+    links = {}
+
+    for path, dirs, files in os.walk(root):
+      dirs.sort()
+      files.sort()
+
+      for name in dirs + files:
+        arcname = os.path.relpath(os.path.join(path, name), root)
+
+        if arcname in exclude:
+          if name in dirs:
+            dirs.remove(name)
+
+          continue
+
+        st = os.lstat(os.path.join(root, arcname))
+        entries.append((arcname, st))
+
+        if stat.S_ISREG(st.st_mode):
+          key = (st.st_dev, st.st_ino)
+          links[key] = links.get(key, 0) + 1
+
+    nlinks = dict(links)
+
+    subdirs = {}
+    for arcname, st in entries:
+      if stat.S_ISDIR(st.st_mode):
+        parent = os.path.dirname(arcname)
+        subdirs[parent] = subdirs.get(parent, 0) + 1
+
+    for arcname, st in entries:
+      mode = stat.S_IFMT(st.st_mode) | stat.S_IMODE(st.st_mode)
+      key = (st.st_dev, st.st_ino)
+
+      if stat.S_ISREG(st.st_mode):
+        links[key] -= 1
+        size = st.st_size if links[key] == 0 else 0
+
+        self.__entry(arcname,
+                     ino = self.__inode(key),
+                     mode = mode,
+                     nlink = nlinks[key],
+                     size = size)
+
+        if size:
+          self.__copy(os.path.join(root, arcname), size)
+
+      elif stat.S_ISLNK(st.st_mode):
+        data = os.readlink(os.path.join(root, arcname))
+
+        self.__entry(arcname,
+                     ino = self.__inode(key),
+                     mode = mode,
+                     nlink = 1,
+                     size = len(data))
+        self.__data(data)
+
+      elif stat.S_ISDIR(st.st_mode):
+        self.__entry(arcname,
+                     ino = self.__inode(key),
+                     mode = mode,
+                     nlink = 2 + subdirs.get(arcname, 0),
+                     size = 0)
+
+      else:
+        self.__entry(arcname,
+                     ino = self.__inode(key),
+                     mode = mode,
+                     nlink = 1,
+                     size = 0,
+                     rdev = (os.major(st.st_rdev), os.minor(st.st_rdev)))
+
+
+  def close(self):
+    self.__entry(TRAILER,
+                 ino = 0,
+                 mode = 0,
+                 nlink = 1,
+                 size = 0)
+
+
+
+COMPRESSORS = {
+  'none' : None,
+  'gzip' : None,
+  # The kernel requires CRC32 checks for xz and the legacy format for lz4
+  'xz' : ['xz', '--check=crc32', '--lzma2=dict=1MiB', '-9', '-c'],
+  'lz4' : ['lz4', '-l', '-9', '-c'],
+  'zstd' : ['zstd', '-19', '-c'],
+}
+
+
+
+@contextlib.contextmanager
+def compressed(path, compression):
+  # Yields a stream compressing into the file - gzip is done in process with
+  # a fixed header, all other formats use the respective tool
+  with open(path, 'wb') as f:
+    if compression == 'none':
+      yield f
+
+    elif compression == 'gzip':
+      stream = gzip.GzipFile(filename = '',
+                             mode = 'wb',
+                             compresslevel = 9,
+                             fileobj = f,
+                             mtime = 0)
+
+      try:
+        yield stream
+
+      finally:
+        stream.close()
+
+    else:
+      process = subprocess.Popen(COMPRESSORS[compression],
+                                 stdin = subprocess.PIPE,
+                                 stdout = f)
+
+      try:
+        yield process.stdin
+
+      finally:
+        process.stdin.close()
+
+        if process.wait() != 0:
+          raise IOError('Compressing with %s failed' % compression)
+
+
+
+def archive(root, path,
+            compression = 'gzip',
+            devices = (),
+            exclude = (),
+            mtime = 0):
+  with compressed(path, compression) as stream:
+    writer = NewcWriter(stream,
+                        mtime = mtime)
+
+    writer.tree(root,
+                exclude = set(exclude) | set(name
+                                             for name, _, _
+                                             in devices))
+
+    for name, major, minor in devices:
+      writer.device(name, major, minor)
+
+    writer.close()
@@ -0,0 +1,260 @@
+import os
+import fcntl
+import shutil
+import urllib2
+import hashlib
+import logging
+import threading
+import contextlib
+
+from dazzle.utils import cachepath, mkpath
+
+
+
+def digest(path, algorithm):
+  h = hashlib.new(algorithm)
+
+  with open(path, 'rb') as f:
+    for chunk in iter(lambda: f.read(1024 * 1024), ''):
+      h.update(chunk)
+
+  return h.hexdigest()
+
+
+
+class ChecksumError(IOError):
+  pass
+
+
+
+class UnpinnedError(Exception):
+  # Not an IOError as retrying doesn't help
+  pass
+
+
+
+class DownloadCache(object):
+  # Source archives are kept by file name and verified by the checksum pinned
+  # per URL as 'ALGORITHM:HEX'. Unpinned archives are only accepted if the
+  # first download is trusted - its SHA-256 is recorded next to the file and
+  # used to verify it later on
+
+  def __init__(self,
+               path = None,
+               mirror = None,
+               trust = False):
+    self.__path = path
+    self.__mirror = mirror
+    self.__trust = trust
+
+    self.__locks = {}
+    self.__lock = threading.Lock()
+
+
+  @property
+  def mirror(self):
+    return self.__mirror
+
+
+  @mirror.setter
+  def mirror(self, value):
+    self.__mirror = value
+
+
+  @property
+  def trust(self):
+    return self.__trust
+
+
+  @trust.setter
+  def trust(self, value):
+    self.__trust = value
+
+
+  def path(self, url):
+    if self.__path is None:
+      self.__path = os.path.dirname(cachepath('sources', 'x'))
+
+    return mkpath(self.__path, url.split('/')[-1])
+
+
+  @contextlib.contextmanager
+  def __locked(self, path):
+    # Serialize fetching the same file by the threads of this process and by
+    # concurrent processes
+    with self.__lock:
+      lock = self.__locks.setdefault(path, threading.Lock())
+
+    with lock:
+      with open('%s.lock' % path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+
+        try:
+          yield
+
+        finally:
+          fcntl.flock(f, fcntl.LOCK_UN)
+
+
+  def __expected(self, path, checksum):
+    if checksum is not None:
+      return checksum.split(':', 1)
+
+    try:
+      with open('%s.sha256' % path, 'r') as f:
+        return 'sha256', f.read().strip()
+
+    except IOError:
+      return None
+
+
+  def verify(self, path, checksum = None):
+    # Returns if the file exists and matches the pinned or recorded checksum
+    if not os.path.exists(path):
+      return False
+
+    expected = self.__expected(path, checksum)
+
+    if expected is None:
+      return True
+
+    algorithm, value = expected
+
+    return digest(path, algorithm) == value.lower()
+
+
+  def __record(self, path, checksum):
+    if checksum is None and not os.path.exists('%s.sha256' % path):
+      with open('%s.sha256' % path, 'w') as f:
+        f.write(digest(path, 'sha256'))
+
+
+  def __feed(self, path, sink, report, limit = None):
+    # Passes the content of a file to the sink
+    size = os.path.getsize(path) if limit is None else limit
+    fed = 0
+
+    with open(path, 'rb') as f:
+      while fed < size:
+        chunk = f.read(min(64 * 1024, size - fed))
+        if not chunk:
+          break
+
+        sink(chunk)
+        fed += len(chunk)
+
+        if report is not None:
+          report(fed, size if limit is None else None)
+
+    return fed
+
+
+  def __download(self, url, path, report, sink):
+    partial = '%s.part' % path
+
+    offset = os.path.getsize(partial) if os.path.exists(partial) else 0
+
+    request = urllib2.Request(url)
+    if offset:
+      request.add_header('Range', 'bytes=%d-' % offset)
+
+    try:
+      response = urllib2.urlopen(request, timeout = 60)
+
+    except urllib2.HTTPError as e:
+      # The partial file is complete or bogus - start over
+      if e.code != 416:
+        raise
+
+      os.unlink(partial)
+      return self.__download(url, path, report, sink)
+
+    # Servers not supporting ranges send the whole file
+    if response.getcode() != 206:
+      offset = 0
+
+    length = response.info().getheader('Content-Length')
+    total = offset + int(length) if length else None
+
+    # The sink gets the already downloaded part first
+    if sink is not None and offset:
+      self.__feed(partial, sink, None, limit = offset)
+
+    with open(partial, 'ab' if offset else 'wb') as f:
+      received = offset
+
+      for chunk in iter(lambda: response.read(64 * 1024), ''):
+        f.write(chunk)
+        received += len(chunk)
+
+        if sink is not None:
+          sink(chunk)
+
+        if report is not None:
+          report(received, total)
+
+    if total is not None and received != total:
+      raise IOError('Incomplete download: %s' % url)
+
+    os.rename(partial, path)
+
+
+  def fetch(self, url, checksum = None, report = None, sink = None):
+    # Returns the path of the verified archive - taken from the cache, the
+    # mirror or the network in this order. The content is passed to the sink
+    # while it is downloaded, but it is verified only afterwards
+    if checksum is None:
+      if not self.trust:
+        raise UnpinnedError('No checksum pinned for %s' % url)
+
+      logging.warning('Trusting unpinned download: %s', url)
+
+    path = self.path(url)
+
+    with self.__locked(path):
+      if self.verify(path, checksum):
+        if sink is not None:
+          self.__feed(path, sink, report)
+
+        return path
+
+      if os.path.exists(path):
+        logging.warning('Discarding corrupt download: %s', path)
+        os.unlink(path)
+
+      if self.mirror is not None:
+        mirrored = mkpath(self.mirror, os.path.basename(path))
+
+        if os.path.exists(mirrored):
+          # Copy to a private file to not clobber a partial download
+          temp = '%s.mirror.%d' % (path, os.getpid())
+
+          try:
+            shutil.copyfile(mirrored, temp)
+            os.rename(temp, path)
+
+          finally:
+            if os.path.exists(temp):
+              os.unlink(temp)
+
+      if os.path.exists(path):
+        streamed = False
+
+      else:
+        self.__download(url, path, report, sink)
+        streamed = True
+
+      if not self.verify(path, checksum):
+        os.unlink(path)
+        raise ChecksumError('Checksum mismatch: %s' % url)
+
+      self.__record(path, checksum)
+
+      if sink is not None and not streamed:
+        self.__feed(path, sink, report)
+
+      return path
+
+
+
+download_cache = DownloadCache.instance = DownloadCache()
@@ -0,0 +1,339 @@
+import os
+import struct
+import threading
+
+
+
+PT_LOAD = 1
+PT_DYNAMIC = 2
+PT_INTERP = 3
+
+DT_NULL = 0
+DT_NEEDED = 1
+DT_STRTAB = 5
+DT_RPATH = 15
+DT_RUNPATH = 29
+
+ELFCLASS64 = 2
+ELFDATA2MSB = 2
+
+# The flags of ld.so.cache entries required for objects of a machine and
+# class - entries of other machines are unknown and accepted as is
+CACHE_FLAGS = {
+  (62, ELFCLASS64) : 0x0303,    # x86-64
+  (3, 1) : 0x0003,              # i386
+  (183, ELFCLASS64) : 0x0a03,   # aarch64
+}
+
+CACHE_MAGIC_OLD = 'ld.so-1.7.0'
+CACHE_MAGIC_NEW = 'glibc-ld.so.cache1.1'
+
+
+
+class ElfFile(object):
+  def __init__(self, path):
+    self.__path = path
+
+    self.__interpreter = None
+    self.__needed = []
+    self.__rpath = []
+    self.__runpath = []
+
+    with open(path, 'rb') as f:
+      self.__parse(f)
+
+
+  @property
+  def path(self):
+    return self.__path
+
+
+  @property
+  def machine(self):
+    return self.__machine, self.__class
+
+
+  @property
+  def interpreter(self):
+    return self.__interpreter
+
+
+  @property
+  def needed(self):
+    return self.__needed
+
+
+  @property
+  def search_path(self):
+    # RPATH is ignored if RUNPATH is set
+    paths = self.__runpath or self.__rpath
+
+    origin = os.path.dirname(os.path.abspath(self.path))
+
+    return [p.replace('$ORIGIN', origin).replace('${ORIGIN}', origin)
+            for p
+            in paths]
+
+
+  def __parse(self, f):
+    ident = f.read(16)
+
+    if len(ident) < 16 or ident[:4] != '\x7fELF':
+      raise ValueError('Not an ELF file: %s' % self.path)
+
+    self.__class = ord(ident[4])
+    order = '>' if ord(ident[5]) == ELFDATA2MSB else '<'
+
+    if self.__class == ELFCLASS64:
+      header = struct.Struct(order + 'HHIQQQIHHHHHH')
+      phdr = struct.Struct(order + 'IIQQQQQQ')
+      dyn = struct.Struct(order + 'qQ')
+
+    else:
+      header = struct.Struct(order + 'HHIIIIIHHHHHH')
+      phdr = struct.Struct(order + 'IIIIIIII')
+      dyn = struct.Struct(order + 'iI')
+
+    (_, self.__machine, _, _,
+     phoff, _, _, _, phentsize, phnum, _, _, _) = header.unpack(f.read(header.size))
+
+    # Segments as (type, offset, vaddr, filesz)
+    segments = []
+
+    for i in xrange(phnum):
+      f.seek(phoff + i * phentsize)
+      fields = phdr.unpack(f.read(phdr.size))
+
+      if self.__class == ELFCLASS64:
+        p_type, _, p_offset, p_vaddr, _, p_filesz, _, _ = fields
+
+      else:
+        p_type, p_offset, p_vaddr, _, p_filesz, _, _, _ = fields
+
+      segments.append((p_type, p_offset, p_vaddr, p_filesz))
+
+    def offset(address):
+      # Maps a virtual address to the file offset by the loaded segments
+      for p_type, p_offset, p_vaddr, p_filesz in segments:
+        if p_type == PT_LOAD and p_vaddr <= address < p_vaddr + p_filesz:
+          return address - p_vaddr + p_offset
+
+      raise ValueError('Invalid address in %s: %x' % (self.path, address))
+
+    def string(position):
+      f.seek(position)
+
+      data = ''
+      while '\0' not in data:
+        chunk = f.read(256)
+        if not chunk:
+          break
+
+        data += chunk
+
+      return data.split('\0', 1)[0]
+
+    entries = []
+
+    for p_type, p_offset, p_vaddr, p_filesz in segments:
+      if p_type == PT_INTERP:
+        self.__interpreter = string(p_offset)
+
+      elif p_type == PT_DYNAMIC:
+        f.seek(p_offset)
+        data = f.read(p_filesz)
+
+        for i in xrange(0, len(data) - dyn.size + 1, dyn.size):
+          tag, value = dyn.unpack_from(data, i)
+
+          if tag == DT_NULL:
+            break
+
+          entries.append((tag, value))
+
+    strtab = [value for tag, value in entries if tag == DT_STRTAB]
+    if not strtab:
+      return
+
+    strtab = offset(strtab[0])
+
+    for tag, value in entries:
+      if tag == DT_NEEDED:
+        self.__needed.append(string(strtab + value))
+
+      elif tag == DT_RPATH:
+        self.__rpath.extend(string(strtab + value).split(':'))
+
+      elif tag == DT_RUNPATH:
+        self.__runpath.extend(string(strtab + value).split(':'))
+
+
+
+def is_elf(path):
+  try:
+    with open(path, 'rb') as f:
+      return f.read(4) == '\x7fELF'
+
+  except IOError:
+    return False
+
+
+
+class LdCache(object):
+  def __init__(self, path = '/etc/ld.so.cache'):
+    # Maps library names to the list of (flags, path) in cache order
+    self.__entries = {}
+
+    try:
+      with open(path, 'rb') as f:
+        data = f.read()
+
+    except IOError:
+      return
+
+    offset = 0
+
+    # Skip the entries of the old format preceding the new one
+    if data.startswith(CACHE_MAGIC_OLD):
+      nlibs, = struct.unpack_from('=I', data, 12)
+      offset = 16 + nlibs * 12
+      offset += -offset % 8
+
+    if data[offset:offset + len(CACHE_MAGIC_NEW)] != CACHE_MAGIC_NEW:
+      return
+
+    nlibs, _ = struct.unpack_from('=II', data, offset + 20)
+
+    # Strings are located relative to the header of the new format
+    def string(position):
+      return data[offset + position:data.index('\0', offset + position)]
+
+    for i in xrange(nlibs):
+      flags, key, value, _, _ = struct.unpack_from('=iIIIQ', data, offset + 48 + i * 24)
+
+      self.__entries.setdefault(string(key), []).append((flags, string(value)))
+
+
+  def lookup(self, name, machine = None):
+    flags = CACHE_FLAGS.get(machine)
+
+    for entry_flags, path in self.__entries.get(name, []):
+      if flags is None or entry_flags == flags:
+        return path
+
+    return None
+
+
+
+class Resolver(object):
+  # Resolves the shared libraries required by ELF objects like the dynamic
+  # linker does - the dependencies of every object are resolved once
+
+  def __init__(self, cache = None):
+    self.__cache = cache or LdCache()
+
+    self.__objects = {}
+    self.__closures = {}
+
+    self.__lock = threading.Lock()
+
+
+  def __object(self, path):
+    if path not in self.__objects:
+      self.__objects[path] = ElfFile(path)
+
+    return self.__objects[path]
+
+
+  def __matches(self, path, machine):
+    try:
+      return self.__object(path).machine == machine
+
+    except (IOError, ValueError):
+      return False
+
+
+  def find(self, name, reference):
+    # Returns the path of the library as loaded for the reference object
+    if '/' in name:
+      return name if os.path.exists(name) else None
+
+    machine = reference.machine
+
+    for directory in reference.search_path:
+      path = os.path.join(directory, name)
+      if os.path.exists(path) and self.__matches(path, machine):
+        return path
+
+    path = self.__cache.lookup(name, machine)
+    if path is not None and os.path.exists(path):
+      return path
+
+    if machine[1] == ELFCLASS64:
+      defaults = ['/lib64', '/usr/lib64', '/lib', '/usr/lib']
+
+    else:
+      defaults = ['/lib', '/usr/lib']
+
+    for directory in defaults:
+      path = os.path.join(directory, name)
+      if os.path.exists(path) and self.__matches(path, machine):
+        return path
+
+    return None
+
+
+  def __closure(self, path):
+    # Walks the dependencies of the object with a worklist - only complete
+    # closures are remembered as a walk cut short by a cycle would be partial
+    if path in self.__closures:
+      return self.__closures[path]
+
+    closure = set()
+
+    visited = set([path])
+    pending = [path]
+
+    while pending:
+      current = pending.pop()
+
+      if current != path and current in self.__closures:
+        closure.update(self.__closures[current])
+        continue
+
+      elf = self.__object(current)
+
+      if elf.interpreter is not None:
+        closure.add(elf.interpreter)
+
+      for name in elf.needed:
+        library = self.find(name, elf)
+
+        if library is None:
+          raise IOError('Can not resolve %s required by %s' % (name, current))
+
+        closure.add(library)
+
+        if library not in visited:
+          visited.add(library)
+          pending.append(library)
+
+    self.__closures[path] = closure
+
+    return closure
+
+
+  def libraries(self, paths):
+    # Returns all libraries required by the given objects
+    with self.__lock:
+      libraries = set()
+
+      for path in paths:
+        libraries.update(self.__closure(path))
+
+      return libraries
+
+
+  def lookup(self, name, reference):
+    with self.__lock:
+      return self.find(name, self.__object(reference))
@@ -0,0 +1,738 @@
+import os
+import sys
+import time
+import errno
+import fcntl
+import heapq
+import socket
+import select
+import itertools
+import threading
+import collections
+import subprocess
+import types
+import Queue as queue
+
+import sh
+
+from dazzle.task import Task, JobState, job_exception_handler, saveiter
+from dazzle.prober import get_prober
+from dazzle.state import host_state
+from dazzle.sshpool import ssh_pool, SSH_OPTIONS
+
+
+
+class Return(BaseException):
+  # Raised by a coroutine to return a value - derived from BaseException to
+  # pass through the generic job exception handlers
+  def __init__(self, value = None):
+    BaseException.__init__(self)
+
+    self.value = value
+
+
+
+class Future(object):
+  def __init__(self):
+    self.__done = False
+
+    self.__result = None
+    self.__exc_info = None
+
+    self.__callbacks = []
+
+
+  @property
+  def done(self):
+    return self.__done
+
+
+  def result(self):
+    assert self.__done
+
+    if self.__exc_info is not None:
+      raise self.__exc_info[0], self.__exc_info[1], self.__exc_info[2]
+
+    return self.__result
+
+
+  def set_result(self, result):
+    self.__finish(result = result,
+                  exc_info = None)
+
+
+  def set_exception(self, exc_info):
+    self.__finish(result = None,
+                  exc_info = exc_info)
+
+
+  def __finish(self, result, exc_info):
+    assert not self.__done
+
+    self.__done = True
+
+    self.__result = result
+    self.__exc_info = exc_info
+
+    callbacks, self.__callbacks = self.__callbacks, None
+    for callback in callbacks:
+      callback(self)
+
+
+  def add_callback(self, callback):
+    if self.__done:
+      callback(self)
+
+    else:
+      self.__callbacks.append(callback)
+
+
+
+class Coroutine(Future):
+  def __init__(self, loop, generator):
+    Future.__init__(self)
+
+    self.__loop = loop
+    self.__generator = generator
+
+    self.__loop.call_soon(self.__step, None, None)
+
+
+  def __step(self, value, exc_info):
+    try:
+      if exc_info is None:
+        yielded = self.__generator.send(value)
+
+      else:
+        yielded = self.__generator.throw(*exc_info)
+
+    except Return as r:
+      self.set_result(r.value)
+      return
+
+    except StopIteration:
+      self.set_result(None)
+      return
+
+    except Exception:
+      self.set_exception(sys.exc_info())
+      return
+
+    try:
+      future = self.__loop.wrap(yielded)
+
+    except Exception:
+      self.__loop.call_soon(self.__step, None, sys.exc_info())
+
+    else:
+      future.add_callback(self.__wakeup)
+
+
+  def __wakeup(self, future):
+    try:
+      value = future.result()
+
+    except Exception:
+      self.__loop.call_soon(self.__step, None, sys.exc_info())
+
+    else:
+      self.__loop.call_soon(self.__step, value, None)
+
+
+
+class Executor(object):
+  def __init__(self, workers):
+    self.__workers = workers
+    self.__threads = []
+
+    self.__queue = queue.Queue()
+
+
+  def submit(self, func):
+    # Start workers lazily until the limit is reached
+    if len(self.__threads) < self.__workers:
+      thread = threading.Thread(target = self.__worker)
+      thread.daemon = True
+      thread.start()
+
+      self.__threads.append(thread)
+
+    self.__queue.put(func)
+
+
+  def __worker(self):
+    while True:
+      self.__queue.get()()
+
+
+
+class Loop(object):
+  def __init__(self, workers = 16):
+    self.__ready = collections.deque()
+
+    self.__timers = []
+    self.__sequence = itertools.count()
+
+    self.__readers = {}
+    self.__writers = {}
+    self.__poll = select.poll()
+
+    self.__threadsafe = collections.deque()
+    self.__threadsafe_lock = threading.Lock()
+
+    self.__wakeup_r, self.__wakeup_w = os.pipe()
+    for fd in (self.__wakeup_r, self.__wakeup_w):
+      nonblocking(fd)
+
+    self.add_reader(self.__wakeup_r, self.__drain)
+
+    self.__executor = Executor(workers = workers)
+
+
+  def call_soon(self, callback, *args):
+    self.__ready.append((callback, args))
+
+
+  def call_later(self, delay, callback, *args):
+    heapq.heappush(self.__timers, (time.time() + delay,
+                                   next(self.__sequence),
+                                   callback,
+                                   args))
+
+
+  def call_soon_threadsafe(self, callback, *args):
+    with self.__threadsafe_lock:
+      self.__threadsafe.append((callback, args))
+
+    try:
+      os.write(self.__wakeup_w, '\0')
+
+    except OSError as e:
+      if e.errno != errno.EAGAIN:
+        raise
+
+
+  def __drain(self):
+    try:
+      while os.read(self.__wakeup_r, 4096):
+        pass
+
+    except OSError as e:
+      if e.errno != errno.EAGAIN:
+        raise
+
+    with self.__threadsafe_lock:
+      self.__ready.extend(self.__threadsafe)
+      self.__threadsafe.clear()
+
+
+  def __register(self, fd):
+    mask = 0
+
+    if fd in self.__readers:
+      mask |= select.POLLIN | select.POLLPRI
+
+    if fd in self.__writers:
+      mask |= select.POLLOUT
+
+    if mask:
+      self.__poll.register(fd, mask)
+
+    else:
+      self.__poll.unregister(fd)
+
+
+  def add_reader(self, fd, callback):
+    self.__readers[fd] = callback
+    self.__register(fd)
+
+
+  def remove_reader(self, fd):
+    if self.__readers.pop(fd, None) is not None:
+      self.__register(fd)
+
+
+  def add_writer(self, fd, callback):
+    self.__writers[fd] = callback
+    self.__register(fd)
+
+
+  def remove_writer(self, fd):
+    if self.__writers.pop(fd, None) is not None:
+      self.__register(fd)
+
+
+  def run_in_executor(self, func, *args):
+    future = Future()
+
+    def call():
+      try:
+        result = func(*args)
+
+      except Exception:
+        self.call_soon_threadsafe(future.set_exception, sys.exc_info())
+
+      else:
+        self.call_soon_threadsafe(future.set_result, result)
+
+    self.__executor.submit(call)
+
+    return future
+
+
+  def wrap(self, thing):
+    # Turns anything a coroutine can yield into a future
+    if isinstance(thing, Future):
+      return thing
+
+    if isinstance(thing, types.GeneratorType):
+      return Coroutine(self, thing)
+
+    if isinstance(thing, (list, tuple)):
+      return gather([self.wrap(x)
+                     for x
+                     in thing])
+
+    future = Future()
+    future.set_result(thing)
+
+    return future
+
+
+  def __tick(self):
+    if self.__ready:
+      timeout = 0
+
+    elif self.__timers:
+      timeout = max(0, self.__timers[0][0] - time.time()) * 1000
+
+    else:
+      timeout = None
+
+    try:
+      events = self.__poll.poll(timeout)
+
+    except select.error as e:
+      if e.args[0] != errno.EINTR:
+        raise
+
+      events = []
+
+    for fd, event in events:
+      if event & (select.POLLIN | select.POLLPRI | select.POLLHUP | select.POLLERR):
+        if fd in self.__readers:
+          self.__readers[fd]()
+
+      if event & (select.POLLOUT | select.POLLHUP | select.POLLERR):
+        if fd in self.__writers:
+          self.__writers[fd]()
+
+    now = time.time()
+
+    while self.__timers and self.__timers[0][0] <= now:
+      _, _, callback, args = heapq.heappop(self.__timers)
+      self.__ready.append((callback, args))
+
+    # Only run the callbacks which are ready now - callbacks scheduled by
+    # them are run in the next tick
+    for _ in xrange(len(self.__ready)):
+      callback, args = self.__ready.popleft()
+      callback(*args)
+
+
+  def run_until_complete(self, thing):
+    future = self.wrap(thing)
+
+    while not future.done:
+      self.__tick()
+
+    return future.result()
+
+
+
+loops = threading.local()
+
+
+
+def get_loop():
+  # Each thread drives its own loop - this allows synchronous tasks to call
+  # asynchronous ones
+  loop = getattr(loops, 'loop', None)
+
+  if loop is None:
+    loop = loops.loop = Loop()
+
+  return loop
+
+
+
+def nonblocking(fd):
+  flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+  fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+
+
+def gather(futures):
+  result = Future()
+
+  if not futures:
+    result.set_result([])
+    return result
+
+  pending = [len(futures)]
+
+  def finished(_):
+    pending[0] -= 1
+
+    if pending[0] == 0:
+      # Raises the first failure, if any
+      try:
+        result.set_result([future.result()
+                           for future
+                           in futures])
+
+      except Exception:
+        result.set_exception(sys.exc_info())
+
+  for future in futures:
+    future.add_callback(finished)
+
+  return result
+
+
+
+def sleep(delay):
+  future = Future()
+  get_loop().call_later(delay, future.set_result, None)
+
+  return future
+
+
+
+def wait_fd(add, remove, fd, timeout):
+  loop = get_loop()
+  future = Future()
+
+  def ready():
+    remove(fd)
+
+    if not future.done:
+      future.set_result(True)
+
+  def expired():
+    if not future.done:
+      remove(fd)
+      future.set_result(False)
+
+  add(fd, ready)
+
+  if timeout is not None:
+    loop.call_later(timeout, expired)
+
+  return future
+
+
+
+def wait(future, timeout):
+  # Waits for the future to finish or the timeout to expire and tells which
+  # one happened first
+  waiter = Future()
+
+  def finished(_ = None):
+    if not waiter.done:
+      waiter.set_result(future.done)
+
+  future.add_callback(finished)
+  get_loop().call_later(timeout, finished)
+
+  return waiter
+
+
+
+def readable(fd, timeout = None):
+  loop = get_loop()
+  return wait_fd(loop.add_reader, loop.remove_reader, fd, timeout)
+
+
+
+def writable(fd, timeout = None):
+  loop = get_loop()
+  return wait_fd(loop.add_writer, loop.remove_writer, fd, timeout)
+
+
+
+def run_in_executor(func, *args):
+  return get_loop().run_in_executor(func, *args)
+
+
+
+def bounded(factories,
+            concurrency = None,
+            rate = None):
+  # Runs the coroutines created by the given factories with at most
+  # concurrency running at once and starting at most rate per second
+  factories = collections.deque(factories)
+
+  next_start = [0.0]
+
+  def worker():
+    while factories:
+      factory = factories.popleft()
+
+      if rate is not None:
+        now = time.time()
+
+        start = max(now, next_start[0])
+        next_start[0] = start + 1.0 / rate
+
+        yield sleep(start - now)
+
+      yield factory()
+
+  count = len(factories)
+  if concurrency is not None:
+    count = min(count, concurrency)
+
+  yield [worker()
+         for _
+         in xrange(count)]
+
+
+
+class ProcessError(sh.ErrorReturnCode):
+  def __init__(self, exit_code, full_cmd, stdout, stderr):
+    sh.ErrorReturnCode.__init__(self, full_cmd, stdout, stderr)
+
+    self.exit_code = exit_code
+
+
+
+Result = collections.namedtuple('Result', ['code', 'stdout', 'stderr'])
+
+
+
+def execute(*args, **kwargs):
+  ok_code = kwargs.pop('ok_code', [0])
+
+  # Passes the output to the given callable as it arrives instead of
+  # collecting it
+  out = kwargs.pop('out', None)
+
+  # Keeps at most the given number of bytes of the collected output - the rest
+  # is read and dropped
+  limit = kwargs.pop('limit', None)
+
+  args = [str(arg) for arg in args]
+
+  with open(os.devnull, 'r') as devnull:
+    process = subprocess.Popen(args,
+                               stdin = devnull,
+                               stdout = subprocess.PIPE,
+                               stderr = subprocess.PIPE,
+                               close_fds = True)
+
+  def collect(pipe, callback = None):
+    fd = pipe.fileno()
+    nonblocking(fd)
+
+    chunks = []
+    kept = 0
+
+    try:
+      while True:
+        yield readable(fd)
+
+        try:
+          chunk = os.read(fd, 65536)
+
+        except OSError as e:
+          if e.errno == errno.EAGAIN:
+            continue
+
+          raise
+
+        if not chunk:
+          break
+
+        if callback is not None:
+          callback(chunk)
+
+        elif limit is None:
+          chunks.append(chunk)
+
+        elif kept < limit:
+          chunks.append(chunk[:limit - kept])
+          kept += len(chunks[-1])
+
+    finally:
+      pipe.close()
+
+    raise Return(''.join(chunks))
+
+  stdout, stderr = yield [collect(process.stdout, out),
+                          collect(process.stderr)]
+
+  # The process closed its output - it has terminated or will do so soon
+  while process.poll() is None:
+    yield sleep(0.01)
+
+  if process.returncode not in ok_code:
+    raise ProcessError(process.returncode, ' '.join(args), stdout, stderr)
+
+  raise Return(Result(code = process.returncode,
+                      stdout = stdout,
+                      stderr = stderr))
+
+
+
+def connect(address, port, timeout = 3):
+  sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+  sock.setblocking(0)
+
+  try:
+    code = sock.connect_ex((address, port))
+
+    if code not in (0, errno.EINPROGRESS):
+      raise socket.error(code, os.strerror(code))
+
+    if not (yield writable(sock.fileno(), timeout = timeout)):
+      raise socket.timeout('Connection timed out')
+
+    code = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+
+    if code != 0:
+      raise socket.error(code, os.strerror(code))
+
+  except:
+    sock.close()
+    raise
+
+  sock.setblocking(1)
+
+  raise Return(sock)
+
+
+
+def ping(host,
+         timeout = 3,
+         count = 3,
+         interval = 0.2,
+         cached = True):
+  if cached:
+    alive = host_state.get(host, 'alive')
+
+    if alive is not None:
+      raise Return(alive)
+
+  loop = get_loop()
+  answered = Future()
+
+  def callback(request):
+    # Called from the prober's receiver thread
+    loop.call_soon_threadsafe(answered.set_result, True)
+
+  request = get_prober().request(address = host.l3addr,
+                                 callback = callback)
+
+  start = time.time()
+  deadline = start + timeout
+
+  try:
+    for i in xrange(count):
+      request.send()
+
+      # Wait for the next round or the deadline after the last one
+      until = deadline
+      if i < count - 1:
+        until = min(start + (i + 1) * interval, deadline)
+
+      if (yield wait(answered, max(0, until - time.time()))):
+        break
+
+  finally:
+    request.cancel()
+
+  host_state.set(host, 'alive', request.answered)
+
+  raise Return(request.answered)
+
+
+
+def ssh(host, *command, **kwargs):
+  # Starting the pooled master connection blocks - do it in the executor
+  options = yield run_in_executor(ssh_pool.options, host)
+
+  result = yield execute('ssh', *(SSH_OPTIONS +
+                                  options +
+                                  [host.l3addr] +
+                                  list(command)),
+                         **kwargs)
+
+  raise Return(result)
+
+
+
+class AsyncTask(Task):
+  # The check and run methods of asynchronous tasks may be generator functions
+  # which are run as coroutines on the event loop of the calling thread. Pre
+  # and post tasks which are not asynchronous are run in the loop's executor.
+
+  def __call__(self):
+    get_loop().run_until_complete(self.call())
+
+
+  @staticmethod
+  def adapt(task):
+    if isinstance(task, AsyncTask):
+      return task.call()
+
+    return run_in_executor(task)
+
+
+  def call(self):
+    with job_exception_handler(self):
+
+      # Check if task must run
+      self.state = JobState.Checking()
+      excuse = yield self.check()
+
+      if excuse is not None:
+        self.state = JobState.Skipped(excuse)
+        return
+
+      # Run pre task(s) unless the resources are held already
+      leased = self.leased
+
+      pre = self.pre
+      if pre is not None and not leased:
+        self.state = JobState.PreRunning()
+        for task in saveiter(pre):
+          yield self.adapt(task)
+
+      # Run the task
+      self.state = JobState.Running()
+
+      for attempt in itertools.count(1):
+        try:
+          message = yield self.run()
+          break
+
+        except Exception as ex:
+          delay = self.retrying(ex, attempt)
+
+          if delay is None:
+            raise
+
+        yield sleep(delay)
+
+        self.state = JobState.Running()
+
+      # Run post task(s)
+      post = self.post
+      if post is not None and not leased:
+        self.state = JobState.PostRunning()
+        for task in saveiter(post):
+          yield self.adapt(task)
+
+      # Update the status
+      self.state = JobState.Success(message)
@@ -0,0 +1,200 @@
+import os
+import re
+import stat
+import shutil
+import collections
+
+import sh
+
+from dazzle.elf import is_elf
+
+
+
+# Kbuild lines adding objects depending on a config symbol
+KBUILD_OBJECTS = re.compile(r'^obj-\$\((CONFIG_\w+)\)\s*[:+]?=\s*(.*)$')
+
+
+
+def module_name(path):
+  # Module names use dashes and underscores interchangeably
+  return os.path.basename(path).split('.', 1)[0].replace('-', '_')
+
+
+
+def strip(root):
+  # Strips the ELF objects of the tree and returns the number of bytes saved.
+  # Stripped files replace the original ones instead of changing them in place
+  # as they may be shared with other trees by hardlinks
+  stripped = {}
+  saved = 0
+
+  for path, dirs, files in os.walk(root):
+    for name in files:
+      name = os.path.join(path, name)
+
+      st = os.lstat(name)
+      if not stat.S_ISREG(st.st_mode) or not is_elf(name):
+        continue
+
+      # Keep hardlinks inside the tree intact
+      key = (st.st_dev, st.st_ino)
+      if key in stripped:
+        os.unlink(name)
+        os.link(stripped[key], name)
+        continue
+
+      # Modules require their symbols to be loaded
+      if name.endswith('.ko'):
+        mode = '--strip-debug'
+
+      else:
+        mode = '--strip-unneeded'
+
+      temp = '%s.strip' % name
+      sh.strip(mode, '-o', temp, name)
+
+      shutil.copystat(name, temp)
+      os.rename(temp, name)
+
+      stripped[key] = name
+      saved += st.st_size - os.path.getsize(name)
+
+  return saved
+
+
+
+def kbuild_modules(source):
+  # Maps the config symbols to the modules built for them by reading the
+  # Kbuild files of the kernel source
+  modules = collections.defaultdict(set)
+
+  for path, dirs, files in os.walk(source):
+    for name in files:
+      if name not in ('Makefile', 'Kbuild'):
+        continue
+
+      with open(os.path.join(path, name), 'r') as f:
+        data = f.read().replace('\\\n', ' ')
+
+      for line in data.splitlines():
+        match = KBUILD_OBJECTS.match(line.strip())
+        if match is None:
+          continue
+
+        symbol, objects = match.groups()
+
+        modules[symbol].update(module_name(o)
+                               for o
+                               in objects.split()
+                               if o.endswith('.o'))
+
+  return modules
+
+
+
+def allowlist(path, source = None):
+  # Reads the names of the modules to keep from a list of names, the output of
+  # lsmod as collected from the machines or a kernel config - the modules of
+  # CONFIG_*=m lines are looked up in the given kernel source
+  modules = set()
+  symbols = None
+
+  with open(path, 'r') as f:
+    for line in f:
+      line = line.split('#', 1)[0].strip()
+
+      if not line or line.startswith('Module '):
+        continue
+
+      if line.startswith('CONFIG_'):
+        symbol, _, value = line.partition('=')
+
+        if value.strip() != 'm':
+          continue
+
+        if symbols is None:
+          symbols = kbuild_modules(source)
+
+        modules.update(symbols.get(symbol, ()))
+
+      else:
+        modules.add(module_name(line.split()[0]))
+
+  return modules
+
+
+
+def prune(root, allowed):
+  # Removes all modules of the tree not required by the allowed ones and
+  # returns the number of removed modules
+  removed = 0
+
+  base = os.path.join(root, 'lib/modules')
+  if not os.path.isdir(base):
+    return 0
+
+  for version in os.listdir(base):
+    tree = os.path.join(base, version)
+
+    def location(module):
+      # Old versions of depmod record absolute paths
+      if os.path.isabs(module):
+        return os.path.join(root, module.lstrip('/'))
+
+      return os.path.join(tree, module)
+
+    requires = {}
+    with open(os.path.join(tree, 'modules.dep'), 'r') as f:
+      for line in f:
+        module, _, dependencies = line.partition(':')
+        requires[module.strip()] = dependencies.split()
+
+    keep = set()
+    pending = [module
+               for module
+               in requires
+               if module_name(module) in allowed]
+
+    while pending:
+      module = pending.pop()
+
+      if module not in keep:
+        keep.add(module)
+        pending.extend(requires.get(module, ()))
+
+    for module in requires:
+      if module not in keep:
+        os.unlink(location(module))
+        removed += 1
+
+    # Rebuild the indexes for the remaining modules
+    sh.depmod('-b', root, version)
+
+  return removed
+
+
+
+def usage(root, owner, exclude = ()):
+  # Sums up the size of the files of the tree by their owner - files are counted
+  # once for all their hardlinks like in the archive
+  totals = collections.defaultdict(int)
+  seen = set()
+
+  for path, dirs, files in os.walk(root):
+    for name in files:
+      relpath = os.path.relpath(os.path.join(path, name), root)
+
+      if relpath in exclude:
+        continue
+
+      st = os.lstat(os.path.join(root, relpath))
+
+      key = (st.st_dev, st.st_ino)
+      if key in seen:
+        continue
+
+      seen.add(key)
+
+      totals[owner(relpath)] += st.st_size
+
+  return totals
@@ -1,22 +1,27 @@
-import socket
-import collections
 import argparse
+import functools
 import logging
-import threading
 import ConfigParser as configparser
 
-from dazzle.task import Task
+from dazzle.task import Task, TaskFailed, JobFailed
+from dazzle.resolver import Resolver
+from dazzle.index import HostIndex, bits
+from dazzle.scheduler import Scheduler
+from dazzle.engine import AsyncTask, get_loop, bounded
+from dazzle.utils import sweep
+from dazzle.policy import FailurePolicy, FailureTracker, RetryPolicy
+from dazzle.lease import leases
 
 
 
 class Host(object):
-  def __init__(self, label, l2addr, l3addr):
+  def __init__(self, label, l2addr, l3addr, priority = 0):
     self.__label = label
 
     self.__l2addr = l2addr
     self.__l3addr = l3addr
 
-    self.__l3addr = socket.gethostbyname(self.__l3addr)
+    self.__priority = priority
 
 
   @property
@@ -34,6 +39,11 @@ class Host(object):
     return self.__l3addr
 
 
+  @property
+  def priority(self):
+    return self.__priority
+
+
   def __str__(self):
     return self.__label
 
@@ -41,40 +51,61 @@ class Host(object):
 
 class HostList(object):
   def __init__(self, path):
-    parser = configparser.SafeConfigParser()
-    parser.read(path)
+    self.__index = HostIndex.load(path)
 
-    self.__hosts = {}
-    self.__groups = collections.defaultdict(lambda: [])
+    # Resolve all host addresses at once
+    l3addrs = Resolver().resolve(options['l3addr']
+                                 for options
+                                 in self.__index.options
+                                 if 'l3addr' in options)
 
-    for label in parser.sections():
+    self.__hosts = []
+    self.__valid = 0
+
+    for i, (label, options) in enumerate(zip(self.__index.labels,
+                                             self.__index.options)):
       try:
+        for option in ('l2addr', 'l3addr'):
+          if option not in options:
+            raise configparser.NoOptionError(option, label)
+
+        l3addr = l3addrs[options['l3addr']]
+
+        if isinstance(l3addr, Exception):
+          raise l3addr
+
         host = Host(label = label,
-                    l2addr = parser.get(label, 'l2addr'),
-                    l3addr = parser.get(label, 'l3addr'))
+                    l2addr = options['l2addr'],
+                    l3addr = l3addr,
+                    priority = int(options.get('priority', 0)))
 
       except Exception as e:
         logging.warn('Ignoring host: %s (%s)', label, e)
 
+        self.__hosts.append(None)
+
       else:
-        self.__hosts[label] = host
+        self.__hosts.append(host)
+        self.__valid |= 1 << i
 
-        if parser.has_option(label, 'group'):
-          for group in parser.get(label, 'group').split(','):
-            self.__groups[group.strip()].append(host)
 
+  @property
+  def index(self):
+    return self.__index
 
-  def get(self, label):
-    if label == '@':
-      return self.__hosts.itervalues()
 
-    if label.startswith('@'):
-      return self.__groups[label[1:]]
+  def hosts(self, bitset):
+    return [self.__hosts[i]
+            for i
+            in bits(bitset & self.__valid)]
 
-    if label in self.__hosts:
-      return [self.__hosts[label]]
 
-    raise KeyError()
+  def select(self, selector):
+    return self.hosts(self.__index.select(selector))
+
+
+  def get(self, label):
+    return self.select(label)
 
 
 
@@ -92,18 +123,30 @@ class HostTask(Task):
     return self.__host
 
 
+  @property
+  def leased(self):
+    # Every use of a leased host extends the lease
+    return leases.renew(self.host)
+
+
 
 class HostSetAction(argparse.Action):
   def __call__(self, parser, namespace, values, option = None):
-    namespace.hosts = set()
+    hostlist = namespace.__hostlist__
+
+    selected = 0
 
     for value in values:
       try:
-        for host in namespace.__hostlist__.get(value):
-          namespace.hosts.add(host)
+        selected |= hostlist.index.select(value)
+
+      except KeyError as e:
+        raise argparse.ArgumentError(self, 'Invalid host: %s' % e.args[0])
+
+      except ValueError as e:
+        raise argparse.ArgumentError(self, 'Invalid selector: %s' % e)
 
-      except KeyError:
-        raise argparse.ArgumentError(self, 'Invalid host: %s' % value)
+    namespace.hosts = hostlist.hosts(selected)
 
 
 
@@ -123,7 +166,11 @@ class HostSetMixin(object):
                           type = str,
                           nargs = '+',
                           action = HostSetAction,
-                          help = 'the hosts to run the task on')
+                          help = 'the hosts to run the task on - a comma '
+                                 'separated list of labels, label ranges '
+                                 '(pc[01-20]), groups (@group) or all hosts '
+                                 '(@), combined with & (intersection) and '
+                                 'prefixed with - (exclusion)')
 
 
 
@@ -132,18 +179,34 @@ def group(taskcls):
   assert issubclass(taskcls, HostTask)
 
   class Wrapped(Task, HostSetMixin):
-    def __init__(self, parent, hosts, **kwargs):
+    def __init__(self, parent, hosts,
+                 parallel = 64,
+                 rate = None,
+                 on_failure = None,
+                 retries = None,
+                 backoff = None,
+                 **kwargs):
       Task.__init__(self,
                     parent = parent)
 
       self.__hosts = hosts
 
+      self.__parallel = parallel
+      self.__rate = rate
+
+      self.__on_failure = on_failure
+
       self.__tasks = [taskcls(parent = self,
                               host = host,
                               **kwargs)
                       for host
                       in hosts]
 
+      for task in self.__tasks:
+        RetryPolicy.apply(task,
+                          attempts = retries,
+                          delay = backoff)
+
 
     @property
     def hosts(self):
@@ -162,21 +225,98 @@ def group(taskcls):
                                 in self.tasks)
 
 
+    def __reclaim(self):
+      # Hosts whose lease expired while being unused are powered off like
+      # released ones - imported late as the tasks are built on this module
+      from dazzle.tasks.ctrl import Shutdown
+
+      tasks = [Shutdown(parent = self,
+                        host = Host(label = lease['label'],
+                                    l2addr = lease.get('l2addr', ''),
+                                    l3addr = address))
+               for address, lease
+               in leases.expire()]
+
+      def isolated(task):
+        try:
+          yield task.call()
+
+        except JobFailed:
+          # The lease is gone anyway - the failure is shown by the task
+          pass
+
+      if tasks:
+        get_loop().run_until_complete(bounded((functools.partial(isolated, task)
+                                               for task
+                                               in tasks),
+                                              concurrency = self.__parallel or None))
+
+
     def run(self):
-      threads = [threading.Thread(target = task)
-                 for task
-                 in self.tasks]
+      self.__reclaim()
+
+      # Learn the state of all hosts in a single pass
+      sweep(self.hosts)
+
+      # Failed hosts are recorded and left behind according to the policy
+      failures = FailureTracker(policy = self.__on_failure,
+                                total = len(self.tasks))
+
+      if issubclass(taskcls, AsyncTask):
+        def isolated(task):
+          try:
+            yield task.call()
+
+          except JobFailed:
+            failures.record(task)
+
+        # Drive all asynchronous host tasks from the event loop of this thread
+        tasks = sorted(self.tasks,
+                       key = lambda task: -task.host.priority)
+
+        get_loop().run_until_complete(bounded((functools.partial(isolated, task)
+                                               for task
+                                               in tasks),
+                                              concurrency = self.__parallel or None,
+                                              rate = self.__rate or None))
+
+      else:
+        def isolated(task):
+          try:
+            task()
+
+          except JobFailed:
+            failures.record(task)
+
+        scheduler = Scheduler(concurrency = self.__parallel or None,
+                              rate = self.__rate or None)
+
+        for task in self.tasks:
+          scheduler.submit(functools.partial(isolated, task),
+                           priority = task.host.priority)
+
+        scheduler.run()
+
+      # Let the host task class aggregate the results of all hosts
+      summary = None
+      if hasattr(taskcls, 'summarize'):
+        summary = taskcls.summarize(self.tasks)
 
-      for thread in threads:
-        thread.start()
+      if failures.failed:
+        raise TaskFailed('\n'.join(message
+                                   for message
+                                   in [summary, failures.report()]
+                                   if message))
 
-      for thread in threads:
-        thread.join()
+      return summary
 
 
     @staticmethod
     def argparser(parser):
       HostSetMixin.argparser(parser)
+      Scheduler.argparser(parser)
+      FailurePolicy.argparser(parser)
+      RetryPolicy.argparser(parser)
 
       # Check if subclass has arguments defined and attach it to the wrapper
       if hasattr(taskcls, 'argparser'):
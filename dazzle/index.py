@@ -0,0 +1,231 @@
+import os
+import re
+import hashlib
+import logging
+import cPickle as pickle
+import ConfigParser as configparser
+
+from dazzle.utils import cachepath, replacing
+
+
+
+def bits(bitset):
+  # Yields the positions of all set bits in ascending order
+  while bitset:
+    lowest = bitset & -bitset
+    yield lowest.bit_length() - 1
+
+    bitset ^= lowest
+
+
+
+def expand_range(spec):
+  # Expands a range specification like '010-020,025' into a list of strings
+  # keeping the zero padding of the bounds
+  for item in spec.split(','):
+    item = item.strip()
+
+    if '-' in item:
+      lower, upper = item.split('-', 1)
+
+    else:
+      lower, upper = item, item
+
+    if not (lower.isdigit() and upper.isdigit()):
+      raise ValueError('Invalid range: %s' % item)
+
+    width = len(lower) if len(lower) == len(upper) else 0
+
+    for i in xrange(int(lower), int(upper) + 1):
+      yield '%0*d' % (width, i)
+
+
+
+class HostIndex(object):
+
+  version = 1
+
+  term_split_re = re.compile(r',(?![^\[]*\])')
+
+  label_range_re = re.compile(r'''
+    ^
+    (?P<prefix>
+      [^\[\]]*
+    )
+    \[(?P<range>
+      [^\[\]]+
+    )\]
+    (?P<suffix>
+      [^\[\]]*
+    )
+    $
+  ''', re.VERBOSE)
+
+
+  def __init__(self, labels, options, groups):
+    self.__labels = labels
+    self.__options = options
+    self.__groups = groups
+
+    self.__ids = {label : i
+                  for i, label
+                  in enumerate(labels)}
+
+    self.__all = (1 << len(labels)) - 1
+
+
+  @property
+  def labels(self):
+    return self.__labels
+
+
+  @property
+  def options(self):
+    return self.__options
+
+
+  @property
+  def groups(self):
+    return self.__groups
+
+
+  @property
+  def all(self):
+    return self.__all
+
+
+  def id(self, label):
+    return self.__ids[label]
+
+
+  @staticmethod
+  def compile(path):
+    parser = configparser.SafeConfigParser()
+    parser.read(path)
+
+    labels = []
+    options = []
+    groups = {}
+
+    for i, label in enumerate(parser.sections()):
+      labels.append(label)
+      options.append(dict(parser.items(label)))
+
+      if parser.has_option(label, 'group'):
+        for group in parser.get(label, 'group').split(','):
+          group = group.strip()
+          groups[group] = groups.get(group, 0) | (1 << i)
+
+    return HostIndex(labels = labels,
+                     options = options,
+                     groups = groups)
+
+
+  @staticmethod
+  def load(path):
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+
+    cache = cachepath('index', '%s.pickle' % hashlib.sha1(path).hexdigest())
+
+    # Use the cached index if the host list was not modified since it was
+    # compiled
+    try:
+      with open(cache, 'rb') as f:
+        data = pickle.load(f)
+
+      if (data['version'] == HostIndex.version and
+          data['path'] == path and
+          data['mtime'] == stat.st_mtime and
+          data['size'] == stat.st_size):
+        return HostIndex(labels = data['labels'],
+                         options = data['options'],
+                         groups = data['groups'])
+
+    except Exception:
+      pass
+
+    index = HostIndex.compile(path)
+
+    try:
+      with replacing(cache) as f:
+        pickle.dump({'version': HostIndex.version,
+                     'path': path,
+                     'mtime': stat.st_mtime,
+                     'size': stat.st_size,
+                     'labels': index.labels,
+                     'options': index.options,
+                     'groups': index.groups},
+                    f,
+                    pickle.HIGHEST_PROTOCOL)
+
+    except (IOError, OSError) as e:
+      logging.debug('Can not write host index cache: %s (%s)', cache, e)
+
+    return index
+
+
+  def __factor(self, factor):
+    if factor == '@':
+      return self.all
+
+    if factor.startswith('@'):
+      return self.groups.get(factor[1:], 0)
+
+    match = self.label_range_re.match(factor)
+    if match:
+      # Labels missing in a range are left out silently to allow gaps
+      bitset = 0
+      for i in expand_range(match.group('range')):
+        label = match.group('prefix') + i + match.group('suffix')
+
+        if label in self.__ids:
+          bitset |= 1 << self.__ids[label]
+
+      return bitset
+
+    if factor in self.__ids:
+      return 1 << self.__ids[factor]
+
+    raise KeyError(factor)
+
+
+  def select(self, selector):
+    # The selector is a comma separated list of terms evaluated from left to
+    # right. A term is a '&' separated list of factors which are intersected.
+    # A term prefixed with '-' is removed from the selection, otherwise it is
+    # added. If the first term is a removal, the selection starts with all
+    # hosts.
+    #
+    # A factor is either '@' for all hosts, '@GROUP' for the hosts in a group,
+    # a host label or a label range like 'pc[010-020,025]'.
+    terms = [term.strip()
+             for term
+             in self.term_split_re.split(selector)]
+
+    if not all(terms):
+      raise ValueError('Empty term in selector: %s' % selector)
+
+    selected = self.all if terms[0].startswith('-') else 0
+
+    for term in terms:
+      exclude = term.startswith('-')
+      if exclude:
+        term = term[1:]
+
+      bitset = self.all
+      for factor in term.split('&'):
+        factor = factor.strip()
+
+        if not factor:
+          raise ValueError('Empty factor in selector: %s' % selector)
+
+        bitset &= self.__factor(factor)
+
+      if exclude:
+        selected &= ~bitset
+
+      else:
+        selected |= bitset
+
+    return selected
@@ -0,0 +1,111 @@
+import os
+import re
+import logging
+import threading
+import contextlib
+import multiprocessing
+
+import sh
+
+
+
+class JobServer(object):
+  # A GNU make job server shared by all make invocations of the process - the
+  # pipe holds a token per job slot and every make takes tokens for its jobs
+  # beyond the first one
+
+  def __init__(self,
+               slots = None):
+    self.__slots = slots or multiprocessing.cpu_count()
+
+    self.__fds = None
+    self.__flags = None
+
+    # Whether a make runs in the slot of the process itself
+    self.__implicit = False
+
+    self.__lock = threading.Lock()
+
+
+  @property
+  def slots(self):
+    return self.__slots
+
+
+  @slots.setter
+  def slots(self, value):
+    with self.__lock:
+      assert self.__fds is None, 'Job server is already running'
+
+      self.__slots = value
+
+
+  def __start(self):
+    if self.__fds is not None:
+      return
+
+    self.__fds = os.pipe()
+    os.write(self.__fds[1], '+' * (self.slots - 1))
+
+    # The option to pass the pipe was renamed in make 4.2
+    try:
+      version = re.match(r'GNU Make (\d+)\.(\d+)',
+                         str(sh.make('--version')))
+
+      version = tuple(int(x) for x in version.groups())
+
+    except Exception as e:
+      logging.debug('Can not determine make version: %s', e)
+      version = (4, 2)
+
+    option = '--jobserver-auth' if version >= (4, 2) else '--jobserver-fds'
+
+    self.__flags = '-j %s=%d,%d' % (option, self.__fds[0], self.__fds[1])
+
+
+  @contextlib.contextmanager
+  def __slot(self):
+    # Every make runs its first job without a token. Concurrent makes take a
+    # token for it like a parent make would - except for the one running in
+    # the slot of the process
+    with self.__lock:
+      implicit = not self.__implicit
+      self.__implicit = True
+
+    if implicit:
+      try:
+        yield
+
+      finally:
+        with self.__lock:
+          self.__implicit = False
+
+    else:
+      token = os.read(self.__fds[0], 1)
+
+      try:
+        yield
+
+      finally:
+        os.write(self.__fds[1], token)
+
+
+  def make(self, *args, **kwargs):
+    # Runs make with the job server - the environment is extended instead of
+    # replaced
+    with self.__lock:
+      self.__start()
+
+    env = dict(os.environ)
+    env.update(kwargs.pop('_env', {}))
+    env['MAKEFLAGS'] = self.__flags
+
+    with self.__slot():
+      return sh.make(*args,
+                     _env = env,
+                     _pass_fds = self.__fds,
+                     **kwargs)
+
+
+
+jobserver = JobServer.instance = JobServer()
@@ -0,0 +1,124 @@
+import json
+import time
+import fcntl
+import contextlib
+import threading
+
+from dazzle.utils import cachepath, replacing
+
+
+
+class LeaseTable(object):
+  def __init__(self,
+               path = None,
+               idle = 1800):
+    self.__path = path
+    self.__idle = idle
+
+    self.__lock = threading.Lock()
+
+
+  @property
+  def path(self):
+    if self.__path is None:
+      self.__path = cachepath('leases.json')
+
+    return self.__path
+
+
+  @property
+  def idle(self):
+    return self.__idle
+
+
+  @idle.setter
+  def idle(self, value):
+    self.__idle = value
+
+
+  def __load(self):
+    try:
+      with open(self.path, 'rb') as data:
+        return json.load(data)
+
+    except (IOError, ValueError):
+      return {}
+
+
+  @contextlib.contextmanager
+  def __locked(self):
+    # Leases are shared by all invocations - serialize the threads of this
+    # process by the lock and the processes by a lock file. The table is only
+    # written if it was changed
+    with self.__lock:
+      with open('%s.lock' % self.path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+
+        try:
+          leases = self.__load()
+          original = json.dumps(leases, sort_keys = True)
+
+          yield leases
+
+          if json.dumps(leases, sort_keys = True) != original:
+            with replacing(self.path) as data:
+              json.dump(leases, data)
+
+        finally:
+          fcntl.flock(f, fcntl.LOCK_UN)
+
+
+  def acquire(self, host, idle = None):
+    # Starts or renews the lease of the host with the given idle timeout
+    idle = idle or self.idle
+
+    with self.__locked() as leases:
+      leases[host.l3addr] = {'label' : host.label,
+                             'l2addr' : host.l2addr,
+                             'idle' : idle,
+                             'expires' : int(time.time() + idle)}
+
+
+  def renew(self, host):
+    # Returns if the host is leased and extends the lease if so - the table is
+    # checked without locking first as most hosts are not leased at all
+    if host.l3addr not in self.__load():
+      return False
+
+    with self.__locked() as leases:
+      lease = leases.get(host.l3addr)
+
+      if lease is None or lease['expires'] <= time.time():
+        return False
+
+      # Deadlines are kept in seconds to write the table once per second at
+      # most
+      lease['expires'] = int(time.time() + lease['idle'])
+
+      return True
+
+
+  def release(self, host):
+    with self.__locked() as leases:
+      return leases.pop(host.l3addr, None) is not None
+
+
+  def expire(self):
+    # Removes the leases which were unused for too long and returns them as
+    # (address, lease) - the caller must release the hosts
+    with self.__locked() as leases:
+      now = time.time()
+
+      expired = [(address, lease)
+                 for address, lease
+                 in leases.iteritems()
+                 if lease['expires'] <= now]
+
+      for address, _ in expired:
+        del leases[address]
+
+      return expired
+
+
+
+leases = LeaseTable.instance = LeaseTable()
@@ -0,0 +1,183 @@
+import argparse
+import threading
+import random
+
+from dazzle.task import job_manager
+from dazzle.utils import positive
+
+
+
+class FailurePolicy(object):
+  def __init__(self,
+               mode = 'abort',
+               threshold = None):
+    assert mode in ('abort', 'continue', 'threshold')
+    assert (mode == 'threshold') == (threshold is not None)
+
+    self.__mode = mode
+    self.__threshold = threshold
+
+
+  @property
+  def mode(self):
+    return self.__mode
+
+
+  @property
+  def threshold(self):
+    return self.__threshold
+
+
+  def exceeded(self, failed, total):
+    if self.mode == 'abort':
+      return failed > 0
+
+    if self.mode == 'continue':
+      return False
+
+    return failed * 100.0 > self.threshold * total
+
+
+  @staticmethod
+  def parse(value):
+    if value in ('abort', 'continue'):
+      return FailurePolicy(mode = value)
+
+    try:
+      if not value.endswith('%'):
+        raise ValueError()
+
+      return FailurePolicy(mode = 'threshold',
+                           threshold = float(value[:-1]))
+
+    except ValueError:
+      raise argparse.ArgumentTypeError('Invalid failure policy: %s' % value)
+
+
+  @staticmethod
+  def argparser(parser):
+    parser.add_argument('--on-failure',
+                        dest = 'on_failure',
+                        metavar = 'POLICY',
+                        default = 'abort',
+                        type = FailurePolicy.parse,
+                        help = 'what to do if hosts fail - "abort" on the '
+                               'first failure, "continue" with the other '
+                               'hosts or abort if more than "N%%" failed')
+
+
+
+class RetryPolicy(object):
+  def __init__(self,
+               attempts = 1,
+               delay = 1.0,
+               factor = 2.0,
+               max_delay = 60.0,
+               jitter = 0.5,
+               exceptions = (),
+               exit_codes = ()):
+    self.__attempts = attempts
+
+    self.__delay = delay
+    self.__factor = factor
+    self.__max_delay = max_delay
+    self.__jitter = jitter
+
+    self.__exceptions = tuple(exceptions)
+    self.__exit_codes = tuple(exit_codes)
+
+
+  @property
+  def attempts(self):
+    return self.__attempts
+
+
+  def retryable(self, ex):
+    if isinstance(ex, self.__exceptions):
+      return True
+
+    # Failed commands are retried depending on their exit code
+    return getattr(ex, 'exit_code', None) in self.__exit_codes
+
+
+  def delay(self, attempt):
+    # Exponential backoff with the given share of randomness to spread the
+    # retries of many hosts
+    delay = min(self.__max_delay,
+                self.__delay * self.__factor ** (attempt - 1))
+
+    return delay * (1.0 - self.__jitter * random.random())
+
+
+  def replace(self,
+              attempts = None,
+              delay = None):
+    return RetryPolicy(attempts = attempts if attempts is not None else self.__attempts,
+                       delay = delay if delay is not None else self.__delay,
+                       factor = self.__factor,
+                       max_delay = self.__max_delay,
+                       jitter = self.__jitter,
+                       exceptions = self.__exceptions,
+                       exit_codes = self.__exit_codes)
+
+
+  @staticmethod
+  def apply(task, attempts = None, delay = None):
+    # Overrides the retry policy of the given task as requested on the
+    # command line
+    if attempts is None and delay is None:
+      return
+
+    task.retry = (task.retry or RetryPolicy()).replace(attempts = attempts,
+                                                       delay = delay)
+
+
+  @staticmethod
+  def argparser(parser):
+    parser.add_argument('--retries',
+                        dest = 'retries',
+                        metavar = 'N',
+                        default = None,
+                        type = positive(int),
+                        help = 'the number of attempts for each host')
+    parser.add_argument('--backoff',
+                        dest = 'backoff',
+                        metavar = 'SECONDS',
+                        default = None,
+                        type = float,
+                        help = 'the initial delay between attempts which is '
+                               'doubled for every retry')
+
+
+
+class FailureTracker(object):
+  def __init__(self, policy, total):
+    self.__policy = policy or FailurePolicy()
+    self.__total = total
+
+    self.__failed = []
+    self.__lock = threading.Lock()
+
+
+  @property
+  def failed(self):
+    return self.__failed
+
+
+  def record(self, task):
+    with self.__lock:
+      self.__failed.append(task)
+
+      if self.__policy.exceeded(len(self.__failed), self.__total):
+        job_manager.abort()
+
+
+  def report(self):
+    if not self.__failed:
+      return None
+
+    return 'Failed hosts (%d / %d): %s' % (len(self.__failed),
+                                           self.__total,
+                                           ', '.join(str(task.element)
+                                                     for task
+                                                     in self.__failed))
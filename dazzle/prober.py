@@ -0,0 +1,337 @@
+import os
+import time
+import errno
+import random
+import select
+import socket
+import struct
+import logging
+import itertools
+import threading
+
+
+
+ICMP_ECHO_REPLY = 0
+ICMP_ECHO_REQUEST = 8
+
+# Port used to probe hosts if no ICMP socket is available - any answer to a
+# connection attempt, even a refused one, proves the host is alive
+FALLBACK_PORT = 22
+
+
+
+def checksum(data):
+  if len(data) % 2:
+    data += '\0'
+
+  total = sum(struct.unpack('!%dH' % (len(data) // 2), data))
+
+  total = (total >> 16) + (total & 0xffff)
+  total += total >> 16
+
+  return ~total & 0xffff
+
+
+
+def open_socket():
+  # Prefer a raw socket, which requires privileges, over the unprivileged
+  # datagram ICMP socket
+  for kind, mode in [(socket.SOCK_RAW, 'raw'),
+                     (socket.SOCK_DGRAM, 'dgram')]:
+    try:
+      sock = socket.socket(socket.AF_INET, kind, socket.IPPROTO_ICMP)
+
+    except socket.error as e:
+      logging.debug('Can not open %s ICMP socket: %s', mode, e)
+      continue
+
+    sock.setblocking(0)
+
+    return sock, mode
+
+  return None, 'tcp'
+
+
+
+class Request(object):
+  def __init__(self, prober, address, callback):
+    self.__prober = prober
+
+    self.__address = address
+    self.__callback = callback
+
+    self.__sent = {}
+    self.__rtt = None
+
+    self.__answered = False
+
+
+  @property
+  def address(self):
+    return self.__address
+
+
+  @property
+  def rtt(self):
+    return self.__rtt
+
+
+  @property
+  def answered(self):
+    return self.__answered
+
+
+  @property
+  def sent(self):
+    return self.__sent
+
+
+  def send(self):
+    if not self.__answered:
+      self.__prober.send(self)
+
+
+  def cancel(self):
+    self.__prober.cancel(self)
+
+
+  def answer(self, rtt):
+    # Called by the prober once for the first reply
+    self.__rtt = rtt
+    self.__answered = True
+
+    if self.__callback is not None:
+      self.__callback(self)
+
+
+
+class Prober(object):
+  def __init__(self,
+               payload_size = 56):
+    self.__socket, self.__mode = open_socket()
+
+    self.__identifier = os.getpid() & 0xffff
+    self.__sequence = itertools.count(random.randint(0, 0xffff))
+
+    self.__payload = ('dazzle' * (payload_size // 6 + 1))[:payload_size]
+
+    # Maps (address, sequence) of ICMP requests or the file descriptor of
+    # connecting sockets to the waiting request
+    self.__waiting = {}
+    self.__connecting = {}
+
+    self.__lock = threading.Condition()
+
+    self.__receiver = threading.Thread(target = self.__receive)
+    self.__receiver.daemon = True
+    self.__receiver.start()
+
+
+  @property
+  def mode(self):
+    return self.__mode
+
+
+  def request(self, address, callback = None):
+    return Request(prober = self,
+                   address = address,
+                   callback = callback)
+
+
+  def send(self, request):
+    with self.__lock:
+      if self.__socket is not None:
+        sequence = next(self.__sequence) & 0xffff
+
+        header = struct.pack('!BBHHH', ICMP_ECHO_REQUEST, 0, 0,
+                             self.__identifier, sequence)
+        header = struct.pack('!BBHHH', ICMP_ECHO_REQUEST, 0,
+                             checksum(header + self.__payload),
+                             self.__identifier, sequence)
+
+        self.__waiting[(request.address, sequence)] = request
+        request.sent[sequence] = time.time()
+
+        try:
+          self.__socket.sendto(header + self.__payload, (request.address, 0))
+
+        except socket.error as e:
+          # Unreachable networks and full buffers are handled like lost
+          # packets
+          logging.debug('Can not send ICMP request to %s: %s', request.address, e)
+
+      else:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(0)
+
+        code = sock.connect_ex((request.address, FALLBACK_PORT))
+
+        now = time.time()
+        request.sent[sock.fileno()] = now
+
+        if code in (0, errno.ECONNREFUSED):
+          sock.close()
+          self.__answer(request, time.time() - now)
+
+        elif code == errno.EINPROGRESS:
+          self.__connecting[sock.fileno()] = (sock, request)
+
+        else:
+          sock.close()
+
+      self.__lock.notify_all()
+
+
+  def cancel(self, request):
+    with self.__lock:
+      self.__forget(request)
+
+
+  def __forget(self, request):
+    for key in request.sent:
+      self.__waiting.pop((request.address, key), None)
+
+      if key in self.__connecting and self.__connecting[key][1] is request:
+        sock, _ = self.__connecting.pop(key)
+        sock.close()
+
+
+  def __answer(self, request, rtt):
+    self.__forget(request)
+
+    if not request.answered:
+      request.answer(rtt)
+
+
+  def __receive(self):
+    while True:
+      with self.__lock:
+        # Sleep until there is something to wait for
+        while not (self.__waiting or self.__connecting):
+          self.__lock.wait()
+
+        poll = select.poll()
+
+        if self.__socket is not None:
+          poll.register(self.__socket.fileno(), select.POLLIN)
+
+        for fd in self.__connecting:
+          poll.register(fd, select.POLLOUT)
+
+      # Wake up regularly to pick up new connecting sockets
+      events = poll.poll(50)
+
+      now = time.time()
+
+      with self.__lock:
+        for fd, event in events:
+          if self.__socket is not None and fd == self.__socket.fileno():
+            self.__receive_icmp(now)
+
+          elif fd in self.__connecting:
+            sock, request = self.__connecting[fd]
+
+            code = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+
+            if code in (0, errno.ECONNREFUSED):
+              self.__answer(request, now - request.sent[fd])
+
+            else:
+              del self.__connecting[fd]
+              sock.close()
+
+
+  def __receive_icmp(self, now):
+    while True:
+      try:
+        packet, (address, _) = self.__socket.recvfrom(4096)
+
+      except socket.error as e:
+        if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+          logging.debug('Can not receive ICMP reply: %s', e)
+
+        return
+
+      # Raw sockets deliver the IP header
+      if self.__mode == 'raw':
+        packet = packet[(ord(packet[0]) & 0x0f) * 4:]
+
+      if len(packet) < 8:
+        continue
+
+      kind, _, _, identifier, sequence = struct.unpack('!BBHHH', packet[:8])
+
+      if kind != ICMP_ECHO_REPLY:
+        continue
+
+      # Datagram sockets have their identifier replaced by the kernel
+      if self.__mode == 'raw' and identifier != self.__identifier:
+        continue
+
+      request = self.__waiting.get((address, sequence))
+      if request is not None:
+        self.__answer(request, now - request.sent[sequence])
+
+
+  def probe(self,
+            addresses,
+            timeout = 3,
+            count = 3,
+            interval = 0.2):
+    # Probes all addresses at once and returns a dict mapping each address to
+    # the round trip time or None if it was not reachable in time
+    condition = threading.Condition()
+
+    def answered(request):
+      with condition:
+        condition.notify_all()
+
+    requests = [self.request(address = address,
+                             callback = answered)
+                for address
+                in set(addresses)]
+
+    start = time.time()
+    deadline = start + timeout
+
+    try:
+      for i in xrange(count):
+        for request in requests:
+          request.send()
+
+        # Wait for the next round or the deadline after the last one
+        until = deadline
+        if i < count - 1:
+          until = min(start + (i + 1) * interval, deadline)
+
+        with condition:
+          while (not all(request.answered for request in requests) and
+                 time.time() < until):
+            condition.wait(until - time.time())
+
+        if (all(request.answered for request in requests) or
+            time.time() >= deadline):
+          break
+
+    finally:
+      for request in requests:
+        request.cancel()
+
+    return {request.address: request.rtt
+            for request
+            in requests}
+
+
+
+probers = []
+probers_lock = threading.Lock()
+
+
+
+def get_prober():
+  # All tasks of the process share a single prober and its socket
+  with probers_lock:
+    if not probers:
+      probers.append(Prober())
+
+    return probers[0]
@@ -0,0 +1,84 @@
+import os
+import time
+import socket
+import subprocess
+
+from dazzle import ready
+
+
+
+QEMU = 'qemu-system-x86_64'
+
+# The address of the host as seen from the user mode network of the emulator
+HOST_ADDRESS = '10.0.2.2'
+
+
+
+def boot(kernel,
+         initrd = None,
+         memory = 512,
+         timeout = 600,
+         log = None):
+  # Boots the image in an emulated machine without hardware acceleration and
+  # waits for the announcement sent as soon as the ssh server is running.
+  # Returns the uptime of the image at this point and the time it took since
+  # starting the emulator
+  sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+  sock.bind(('127.0.0.1', 0))
+
+  _, port = sock.getsockname()
+
+  command = [QEMU,
+             '-machine', 'accel=tcg',
+             '-m', str(memory),
+             '-nographic',
+             '-no-reboot',
+             '-kernel', kernel,
+             '-append', 'console=ttyS0 panic=-1 dazzle.ready=%s:%d' % (HOST_ADDRESS,
+                                                                        port),
+             '-netdev', 'user,id=net0',
+             '-device', 'e1000,netdev=net0']
+
+  if initrd is not None:
+    command += ['-initrd', initrd]
+
+  started = time.time()
+
+  with open(os.devnull, 'r') as null:
+    process = subprocess.Popen(command,
+                               stdin = null,
+                               stdout = log,
+                               stderr = log)
+
+  try:
+    while True:
+      remaining = started + timeout - time.time()
+
+      if remaining <= 0:
+        raise IOError('Image not ready after %d s' % timeout)
+
+      if process.poll() is not None:
+        raise IOError('Emulator exited with %d' % process.returncode)
+
+      sock.settimeout(min(remaining, 1.0))
+
+      try:
+        data, (address, _) = sock.recvfrom(512)
+
+      except socket.timeout:
+        continue
+
+      try:
+        announcement = ready.parse(data, address)
+
+      except ValueError:
+        continue
+
+      return announcement.uptime, announcement.received - started
+
+  finally:
+    if process.poll() is None:
+      process.kill()
+      process.wait()
+
+    sock.close()
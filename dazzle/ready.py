@@ -0,0 +1,150 @@
+import time
+import errno
+import socket
+import logging
+import threading
+import collections
+
+
+
+READY_PORT = 16962
+
+
+
+Announcement = collections.namedtuple('Announcement', ['hostname',
+                                                       'l2addr',
+                                                       'l3addr',
+                                                       'uptime',
+                                                       'received'])
+
+
+
+def parse(data, address):
+  # The maintenance image sends 'dazzle-ready HOSTNAME MAC IP UPTIME' - the
+  # address is taken from the sender to not trust the content blindly
+  fields = data.split()
+
+  if len(fields) != 5 or fields[0] != 'dazzle-ready':
+    raise ValueError('Invalid announcement: %r' % data)
+
+  return Announcement(hostname = fields[1],
+                      l2addr = fields[2].lower(),
+                      l3addr = address,
+                      uptime = float(fields[4]),
+                      received = time.time())
+
+
+
+class ReadyListener(object):
+  def __init__(self,
+               port = READY_PORT):
+    self.__port = port
+
+    self.__socket = None
+    self.__thread = None
+
+    # Maps addresses of both layers to the last announcement
+    self.__announcements = {}
+
+    self.__condition = threading.Condition()
+
+
+  @property
+  def port(self):
+    return self.__port
+
+
+  @port.setter
+  def port(self, value):
+    self.__port = value
+
+
+  @property
+  def listening(self):
+    return self.__socket is not None
+
+
+  def listen(self):
+    # Starts the listener if not done yet - returns False if announcements
+    # can't be received and the caller must fall back to polling
+    with self.__condition:
+      if self.__thread is not None:
+        return self.listening
+
+      self.__thread = threading.Thread(target = self.__receive)
+      self.__thread.daemon = True
+
+      if not self.port:
+        return False
+
+      try:
+        self.__socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.__socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.__socket.bind(('', self.port))
+
+      except socket.error as e:
+        logging.debug('Can not listen for announcements on port %d: %s',
+                      self.port, e)
+
+        self.__socket = None
+        return False
+
+      self.__thread.start()
+
+      return True
+
+
+  def __receive(self):
+    while True:
+      try:
+        data, (address, _) = self.__socket.recvfrom(512)
+
+      except socket.error as e:
+        if e.errno == errno.EINTR:
+          continue
+
+        raise
+
+      try:
+        announcement = parse(data, address)
+
+      except ValueError as e:
+        logging.debug('Ignoring announcement from %s: %s', address, e)
+        continue
+
+      with self.__condition:
+        self.__announcements[announcement.l3addr] = announcement
+        self.__announcements[announcement.l2addr] = announcement
+
+        self.__condition.notify_all()
+
+
+  def announcement(self, host, since = 0):
+    # Returns the last announcement of the host received after the given time
+    with self.__condition:
+      for address in (host.l3addr, host.l2addr.lower()):
+        announcement = self.__announcements.get(address)
+
+        if announcement is not None and announcement.received >= since:
+          return announcement
+
+    return None
+
+
+  def wait(self, host, timeout, since = 0):
+    # Blocks until the host announces itself or the timeout expired
+    deadline = time.time() + timeout
+
+    with self.__condition:
+      while True:
+        announcement = self.announcement(host, since)
+
+        remaining = deadline - time.time()
+        if announcement is not None or remaining <= 0:
+          return announcement
+
+        self.__condition.wait(remaining)
+
+
+
+ready_listener = ReadyListener.instance = ReadyListener()
@@ -0,0 +1,127 @@
+import json
+import time
+import socket
+import logging
+import threading
+import Queue as queue
+
+from dazzle.utils import cachepath, replacing
+
+
+
+def is_address(name):
+  try:
+    socket.inet_aton(name)
+
+  except socket.error:
+    return False
+
+  return name.count('.') == 3
+
+
+
+class Resolver(object):
+  def __init__(self,
+               path = None,
+               ttl = 3600,
+               workers = 32):
+    self.__path = path or cachepath('resolve.json')
+
+    self.__ttl = ttl
+    self.__workers = workers
+
+    self.__cache = self.__load()
+
+
+  @property
+  def ttl(self):
+    return self.__ttl
+
+
+  @property
+  def workers(self):
+    return self.__workers
+
+
+  def __load(self):
+    try:
+      with open(self.__path, 'r') as f:
+        cache = json.load(f)
+
+    except (IOError, ValueError):
+      return {}
+
+    if not isinstance(cache, dict):
+      return {}
+
+    return cache
+
+
+  def __save(self):
+    try:
+      with replacing(self.__path) as f:
+        json.dump(self.__cache, f)
+
+    except (IOError, OSError) as e:
+      logging.debug('Can not write resolver cache: %s (%s)', self.__path, e)
+
+
+  def resolve(self, names):
+    # Maps each name to either the resolved address or the exception raised
+    # while resolving it
+    results = {}
+    pending = queue.Queue()
+
+    now = time.time()
+
+    for name in set(names):
+      if is_address(name):
+        results[name] = name
+        continue
+
+      entry = self.__cache.get(name)
+      if entry is not None and now - entry[1] < self.ttl:
+        results[name] = entry[0]
+        continue
+
+      pending.put(name)
+
+    if pending.empty():
+      return results
+
+    lock = threading.Lock()
+
+    def worker():
+      while True:
+        try:
+          name = pending.get_nowait()
+
+        except queue.Empty:
+          return
+
+        try:
+          result = socket.gethostbyname(name)
+
+        except Exception as e:
+          result = e
+
+        with lock:
+          results[name] = result
+
+          if not isinstance(result, Exception):
+            self.__cache[name] = (result, time.time())
+
+    threads = [threading.Thread(target = worker)
+               for _
+               in xrange(min(self.workers, pending.qsize()))]
+
+    for thread in threads:
+      thread.daemon = True
+      thread.start()
+
+    for thread in threads:
+      thread.join()
+
+    self.__save()
+
+    return results
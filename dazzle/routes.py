@@ -0,0 +1,170 @@
+import json
+import socket
+import struct
+import logging
+import threading
+import collections
+
+import sh
+
+
+
+RTF_UP = 0x0001
+RTF_REJECT = 0x0200
+
+
+
+Route = collections.namedtuple('Route', ['network',
+                                         'length',
+                                         'device',
+                                         'gateway',
+                                         'metric'])
+
+
+
+def address_to_int(address):
+  return struct.unpack('!I', socket.inet_aton(address))[0]
+
+
+
+def int_to_address(value):
+  return socket.inet_ntoa(struct.pack('!I', value))
+
+
+
+def mask_to_length(mask):
+  return bin(mask).count('1')
+
+
+
+class RouteTable(object):
+  def __init__(self, routes):
+    # Binary prefix trie - each node is a list of the child for a cleared bit,
+    # the child for a set bit and the route ending at the node
+    self.__root = [None, None, None]
+
+    for route in routes:
+      self.insert(route)
+
+
+  def insert(self, route):
+    network = address_to_int(route.network)
+
+    node = self.__root
+    for i in xrange(route.length):
+      bit = (network >> (31 - i)) & 1
+
+      if node[bit] is None:
+        node[bit] = [None, None, None]
+
+      node = node[bit]
+
+    # Keep the route with the lowest metric for the same prefix
+    if node[2] is None or route.metric < node[2].metric:
+      node[2] = route
+
+
+  def lookup(self, address):
+    address = address_to_int(address)
+
+    match = None
+
+    node = self.__root
+    for i in xrange(33):
+      if node[2] is not None:
+        match = node[2]
+
+      if i == 32:
+        break
+
+      node = node[(address >> (31 - i)) & 1]
+
+      if node is None:
+        break
+
+    return match
+
+
+  @staticmethod
+  def from_proc(path = '/proc/net/route'):
+    routes = []
+
+    with open(path, 'r') as f:
+      next(f)
+
+      for line in f:
+        fields = line.split()
+
+        device = fields[0]
+        flags = int(fields[3], 16)
+
+        if not flags & RTF_UP or flags & RTF_REJECT:
+          continue
+
+        # The kernel prints the addresses in host byte order
+        network = socket.ntohl(int(fields[1], 16))
+        gateway = socket.ntohl(int(fields[2], 16))
+        mask = socket.ntohl(int(fields[7], 16))
+
+        routes.append(Route(network = int_to_address(network),
+                            length = mask_to_length(mask),
+                            device = device,
+                            gateway = int_to_address(gateway) if gateway else None,
+                            metric = int(fields[6])))
+
+    return RouteTable(routes)
+
+
+  @staticmethod
+  def from_ip():
+    routes = []
+
+    for entry in json.loads(str(sh.ip('-j', '-4', 'route', 'show'))):
+      if entry.get('type', 'unicast') != 'unicast' or 'dev' not in entry:
+        continue
+
+      dst = entry['dst']
+
+      if dst == 'default':
+        network, length = '0.0.0.0', 0
+
+      elif '/' in dst:
+        network, length = dst.split('/')
+        length = int(length)
+
+      else:
+        network, length = dst, 32
+
+      routes.append(Route(network = network,
+                          length = length,
+                          device = entry['dev'],
+                          gateway = entry.get('gateway'),
+                          metric = entry.get('metric', 0)))
+
+    return RouteTable(routes)
+
+
+  @staticmethod
+  def load():
+    try:
+      return RouteTable.from_proc()
+
+    except (IOError, OSError) as e:
+      logging.debug('Can not read kernel routing table: %s', e)
+
+    return RouteTable.from_ip()
+
+
+
+route_tables = []
+route_tables_lock = threading.Lock()
+
+
+
+def get_route_table():
+  # The routing table is loaded once and shared by all tasks of the process
+  with route_tables_lock:
+    if not route_tables:
+      route_tables.append(RouteTable.load())
+
+    return route_tables[0]
@@ -0,0 +1,123 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+from dazzle.utils import positive
+
+
+
+class Scheduler(object):
+  def __init__(self,
+               concurrency = 64,
+               rate = None):
+    assert concurrency is None or concurrency > 0
+    assert rate is None or rate > 0
+
+    self.__concurrency = concurrency
+    self.__rate = rate
+
+    self.__pending = []
+    self.__sequence = itertools.count()
+
+    self.__active = 0
+    self.__condition = threading.Condition()
+
+    self.__next_start = 0.0
+
+
+  @property
+  def concurrency(self):
+    return self.__concurrency
+
+
+  @property
+  def rate(self):
+    return self.__rate
+
+
+  def submit(self, func, priority = 0):
+    # Pending functions are ordered by descending priority and submission order
+    with self.__condition:
+      heapq.heappush(self.__pending, (-priority,
+                                      next(self.__sequence),
+                                      func))
+
+      self.__condition.notify()
+
+
+  def __throttle(self):
+    if self.rate is None:
+      return
+
+    with self.__condition:
+      now = time.time()
+
+      start = max(now, self.__next_start)
+      self.__next_start = start + 1.0 / self.rate
+
+    time.sleep(start - now)
+
+
+  def __worker(self):
+    while True:
+      with self.__condition:
+        # Wait for work as long as running functions may submit more of it
+        while not self.__pending and self.__active > 0:
+          self.__condition.wait()
+
+        if not self.__pending:
+          self.__condition.notify_all()
+          return
+
+        _, _, func = heapq.heappop(self.__pending)
+        self.__active += 1
+
+      try:
+        self.__throttle()
+        func()
+
+      except Exception:
+        logging.exception('Scheduled function failed')
+
+      finally:
+        with self.__condition:
+          self.__active -= 1
+          self.__condition.notify_all()
+
+
+  def run(self):
+    with self.__condition:
+      count = len(self.__pending)
+
+    if self.concurrency is not None:
+      count = min(count, self.concurrency)
+
+    threads = [threading.Thread(target = self.__worker)
+               for _
+               in xrange(count)]
+
+    for thread in threads:
+      thread.daemon = True
+      thread.start()
+
+    for thread in threads:
+      thread.join()
+
+
+  @staticmethod
+  def argparser(parser):
+    parser.add_argument('--parallel',
+                        dest = 'parallel',
+                        metavar = 'N',
+                        default = 64,
+                        type = positive(int),
+                        help = 'the maximum number of hosts to work on at '
+                               'once')
+    parser.add_argument('--rate',
+                        dest = 'rate',
+                        metavar = 'N',
+                        default = None,
+                        type = positive(float),
+                        help = 'the maximum number of hosts to start per second')
@@ -0,0 +1,222 @@
+import os
+import time
+import atexit
+import shutil
+import logging
+import tempfile
+import threading
+import subprocess
+
+
+
+SSH_OPTIONS = ['-o', 'UserKnownHostsFile=/dev/null',
+               '-o', 'StrictHostKeyChecking=no',
+               '-o', 'PasswordAuthentication=no',
+               '-o', 'LogLevel=ERROR',
+               '-l', 'root']
+
+
+
+class ConnectionPool(object):
+  def __init__(self,
+               limit = 64,
+               idle = 60):
+    self.__limit = limit
+    self.__idle = idle
+
+    self.__directory = None
+
+    # Maps host addresses to the time the master connection was last used
+    self.__masters = {}
+    self.__starting = {}
+
+    # Forgotten masters may still carry sessions - their successors get a
+    # control path of their own
+    self.__generations = {}
+
+    self.__lock = threading.Lock()
+
+
+  @property
+  def limit(self):
+    return self.__limit
+
+
+  @limit.setter
+  def limit(self, value):
+    self.__limit = value
+
+
+  @property
+  def idle(self):
+    return self.__idle
+
+
+  @idle.setter
+  def idle(self, value):
+    self.__idle = value
+
+
+  def __path(self, address):
+    if self.__directory is None:
+      self.__directory = tempfile.mkdtemp(prefix = 'dazzle-ssh-')
+      atexit.register(self.close)
+
+    return os.path.join(self.__directory,
+                        '%s-%d' % (address, self.__generations.get(address, 0)))
+
+
+  def __control(self, address, path, command):
+    # Must be called without holding the lock
+    with open(os.devnull, 'r+') as devnull:
+      return subprocess.call(['ssh'] +
+                             SSH_OPTIONS +
+                             ['-o', 'ControlPath=%s' % path,
+                              '-O', command,
+                              address],
+                             stdin = devnull,
+                             stdout = devnull,
+                             stderr = devnull)
+
+
+  def __forget(self, address):
+    # Returns the control path of the forgotten master or None
+    if self.__masters.pop(address, None) is None:
+      return None
+
+    path = self.__path(address)
+    self.__generations[address] = self.__generations.get(address, 0) + 1
+
+    return path
+
+
+  def __expire(self, now):
+    # Masters exit on their own after being idle for too long. The time of the
+    # last started session doesn't tell about running ones - the master is
+    # forgotten but left alone
+    for address, used in self.__masters.items():
+      if now - used > self.idle:
+        self.__forget(address)
+
+
+  def __evict(self):
+    # Forget the least recently used master - returns its control path to stop
+    # it, which keeps the running sessions alive
+    address = min(self.__masters, key = self.__masters.get)
+
+    return address, self.__forget(address)
+
+
+  def __start(self, address):
+    with open(os.devnull, 'r+') as devnull:
+      code = subprocess.call(['ssh'] +
+                             SSH_OPTIONS +
+                             ['-o', 'ControlMaster=yes',
+                              '-o', 'ControlPath=%s' % self.__path(address),
+                              '-o', 'ControlPersist=%d' % self.idle,
+                              '-N', '-f',
+                              address],
+                             stdin = devnull,
+                             stdout = devnull,
+                             stderr = devnull)
+
+    return code == 0
+
+
+  def options(self, host):
+    # Returns the ssh options to multiplex a session over the master
+    # connection to the host - the master is started if required
+    address = host.l3addr
+
+    with self.__lock:
+      now = time.time()
+      self.__expire(now)
+
+      if address in self.__masters:
+        self.__masters[address] = now
+        return self.__options(address)
+
+      # Only one thread starts the master for a host - the others wait for it
+      starting = self.__starting.get(address)
+
+      evicted = None
+
+      if starting is None:
+        starting = self.__starting[address] = threading.Event()
+        owner = True
+
+        if self.limit and len(self.__masters) >= self.limit:
+          evicted = self.__evict()
+
+      else:
+        owner = False
+
+    if evicted is not None:
+      self.__control(evicted[0], evicted[1], 'stop')
+
+    if not owner:
+      starting.wait()
+
+      with self.__lock:
+        if address in self.__masters:
+          return self.__options(address)
+
+        return ['-o', 'ControlPath=none']
+
+    try:
+      started = self.__start(address)
+
+    except OSError as e:
+      logging.debug('Can not start ssh master for %s: %s', address, e)
+      started = False
+
+    with self.__lock:
+      del self.__starting[address]
+      starting.set()
+
+      if not started:
+        return ['-o', 'ControlPath=none']
+
+      self.__masters[address] = time.time()
+      return self.__options(address)
+
+
+  def __options(self, address):
+    return ['-o', 'ControlMaster=no',
+            '-o', 'ControlPath=%s' % self.__path(address)]
+
+
+  def invalidate(self, host):
+    # Forget a possibly broken master - sessions running over it are left alone
+    # and the next session starts a new master
+    with self.__lock:
+      self.__forget(host.l3addr)
+
+
+  def terminate(self, host):
+    # Stop the master of a host which is going away - this ends all sessions
+    # running over it
+    with self.__lock:
+      path = self.__forget(host.l3addr)
+
+    if path is not None:
+      self.__control(host.l3addr, path, 'exit')
+
+
+  def close(self):
+    with self.__lock:
+      masters = [(address, self.__forget(address))
+                 for address
+                 in self.__masters.keys()]
+
+    for address, path in masters:
+      self.__control(address, path, 'exit')
+
+    with self.__lock:
+      if self.__directory is not None:
+        shutil.rmtree(self.__directory, ignore_errors = True)
+        self.__directory = None
+
+
+
+ssh_pool = ConnectionPool.instance = ConnectionPool()
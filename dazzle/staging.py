@@ -0,0 +1,274 @@
+import os
+import stat
+import errno
+import fcntl
+import shutil
+import hashlib
+import collections
+
+from dazzle import steps
+
+
+
+# ioctl to share the extents of a file with another one on filesystems
+# supporting reflinks
+FICLONE = 0x40049409
+
+
+
+Entry = collections.namedtuple('Entry', ['kind',
+                                         'path',
+                                         'source',
+                                         'mode',
+                                         'rdev'])
+
+
+
+def digest(path):
+  h = hashlib.sha1()
+
+  with open(path, 'rb') as f:
+    for chunk in iter(lambda: f.read(1024 * 1024), ''):
+      h.update(chunk)
+
+  return h.hexdigest()
+
+
+
+def makedirs(path, mode = 0755):
+  try:
+    os.makedirs(path, mode)
+
+  except OSError as e:
+    if e.errno != errno.EEXIST or not os.path.isdir(path):
+      raise
+
+
+
+class Manifest(object):
+  # A declarative description of the files to place into a root tree - all
+  # entries are applied at once without forking a process per file
+
+  def __init__(self, hardlink = False):
+    self.__hardlink = hardlink
+
+    self.__entries = collections.OrderedDict()
+
+
+  def __len__(self):
+    return len(self.__entries)
+
+
+  @property
+  def paths(self):
+    return self.__entries.keys()
+
+
+  def digest(self):
+    # Describes the entries and the state of the files they are copied from
+    return steps.digest(values = self.__entries.values(),
+                        files = [entry.source
+                                 for entry
+                                 in self.__entries.itervalues()
+                                 if entry.kind == 'file'])
+
+
+  def __add(self, kind, path, source = None, mode = None, rdev = None):
+    path = os.path.normpath(path.lstrip('/'))
+
+    self.__entries[path] = Entry(kind = kind,
+                                 path = path,
+                                 source = source,
+                                 mode = mode,
+                                 rdev = rdev)
+
+
+  def directory(self, path, mode = 0755):
+    self.__add('directory', path, mode = mode)
+
+
+  def file(self, path, source, mode = None):
+    # The file is copied from the source which is followed if it's a symlink
+    self.__add('file', path, source = source, mode = mode)
+
+
+  def content(self, path, data, mode = 0644):
+    self.__add('content', path, source = data, mode = mode)
+
+
+  def symlink(self, path, target):
+    self.__add('symlink', path, source = target)
+
+
+  def link(self, path, target):
+    # A hardlink to another path inside the tree
+    self.__add('link', path, source = target)
+
+
+  def device(self, path, major, minor, mode = 0644):
+    self.__add('device', path, mode = stat.S_IFCHR | mode,
+               rdev = os.makedev(major, minor))
+
+
+  def tree(self, source, path = ''):
+    # Adds all entries of a directory tree
+    for root, dirs, files in os.walk(source):
+      dirs.sort()
+      files.sort()
+
+      for name in dirs + files:
+        src = os.path.join(root, name)
+        dst = os.path.join(path, os.path.relpath(src, source))
+
+        st = os.lstat(src)
+
+        if stat.S_ISLNK(st.st_mode):
+          self.symlink(dst, os.readlink(src))
+
+        elif stat.S_ISDIR(st.st_mode):
+          self.directory(dst, stat.S_IMODE(st.st_mode))
+
+        elif stat.S_ISREG(st.st_mode):
+          self.file(dst, src)
+
+        elif stat.S_ISCHR(st.st_mode):
+          self.device(dst,
+                      os.major(st.st_rdev),
+                      os.minor(st.st_rdev),
+                      stat.S_IMODE(st.st_mode))
+
+
+  def __copy(self, source, target, mode):
+    # Prefer sharing the data with the source - a hardlink is only used if
+    # allowed as changing the target would change the source as well
+    if self.__hardlink and stat.S_IMODE(os.stat(source).st_mode) == mode:
+      try:
+        os.link(os.path.realpath(source), target)
+        return
+
+      except OSError:
+        pass
+
+    with open(source, 'rb') as src:
+      with open(target, 'wb') as dst:
+        try:
+          fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+
+        except IOError:
+          shutil.copyfileobj(src, dst, 1024 * 1024)
+
+    shutil.copystat(source, target)
+    os.chmod(target, mode)
+
+
+  def __unchanged(self, source, target):
+    # Compare the content only if the size matches and the copy is not known
+    # to be up to date by its timestamp
+    try:
+      st = os.lstat(target)
+
+    except OSError:
+      return False
+
+    if not stat.S_ISREG(st.st_mode):
+      return False
+
+    src = os.stat(source)
+
+    if src.st_size != st.st_size:
+      return False
+
+    if int(src.st_mtime) == int(st.st_mtime):
+      return True
+
+    return digest(source) == digest(target)
+
+
+  def __remove(self, target):
+    if os.path.isdir(target) and not os.path.islink(target):
+      shutil.rmtree(target)
+
+    elif os.path.lexists(target):
+      os.unlink(target)
+
+
+  def apply(self, root, report = None):
+    # Returns the number of entries which were changed
+    changed = 0
+
+    for i, entry in enumerate(self.__entries.itervalues()):
+      if report is not None:
+        report(i + 1, len(self.__entries))
+
+      target = os.path.join(root, entry.path)
+
+      if entry.kind == 'directory':
+        if os.path.lexists(target) and not os.path.isdir(target):
+          self.__remove(target)
+
+        makedirs(target, entry.mode)
+        os.chmod(target, entry.mode)
+        continue
+
+      makedirs(os.path.dirname(target))
+
+      if entry.kind == 'file':
+        mode = entry.mode
+        if mode is None:
+          mode = stat.S_IMODE(os.stat(entry.source).st_mode)
+
+        if self.__unchanged(entry.source, target):
+          os.chmod(target, mode)
+          continue
+
+        self.__remove(target)
+        self.__copy(entry.source, target, mode)
+
+      elif entry.kind == 'content':
+        try:
+          with open(target, 'rb') as f:
+            if f.read() == entry.source:
+              os.chmod(target, entry.mode)
+              continue
+
+        except IOError:
+          pass
+
+        self.__remove(target)
+        with open(target, 'wb') as f:
+          f.write(entry.source)
+
+        os.chmod(target, entry.mode)
+
+      elif entry.kind == 'symlink':
+        if os.path.islink(target) and os.readlink(target) == entry.source:
+          continue
+
+        self.__remove(target)
+        os.symlink(entry.source, target)
+
+      elif entry.kind == 'link':
+        source = os.path.join(root, entry.source)
+
+        if os.path.exists(target) and os.path.samefile(source, target):
+          continue
+
+        self.__remove(target)
+        os.link(source, target)
+
+      elif entry.kind == 'device':
+        try:
+          st = os.lstat(target)
+
+          if st.st_mode == entry.mode and st.st_rdev == entry.rdev:
+            continue
+
+        except OSError:
+          pass
+
+        self.__remove(target)
+        os.mknod(target, entry.mode, entry.rdev)
+
+      changed += 1
+
+    return changed
@@ -0,0 +1,55 @@
+import time
+import threading
+
+
+
+class HostState(object):
+  def __init__(self, ttl = 30.0):
+    self.__ttl = ttl
+
+    self.__entries = {}
+    self.__lock = threading.Lock()
+
+
+  @property
+  def ttl(self):
+    return self.__ttl
+
+
+  @ttl.setter
+  def ttl(self, value):
+    self.__ttl = value
+
+
+  def get(self, host, key):
+    # Returns the last known value or None if it is unknown or outdated
+    with self.__lock:
+      entry = self.__entries.get(host, {}).get(key)
+
+    if entry is None:
+      return None
+
+    value, timestamp = entry
+
+    if time.time() - timestamp >= self.ttl:
+      return None
+
+    return value
+
+
+  def set(self, host, key, value):
+    with self.__lock:
+      self.__entries.setdefault(host, {})[key] = (value, time.time())
+
+
+  def invalidate(self, host, key = None):
+    with self.__lock:
+      if key is None:
+        self.__entries.pop(host, None)
+
+      else:
+        self.__entries.get(host, {}).pop(key, None)
+
+
+
+host_state = HostState.instance = HostState()
@@ -0,0 +1,67 @@
+import os
+import json
+import hashlib
+
+from dazzle.utils import replacing
+
+
+
+def digest(values = (), files = ()):
+  # Files are identified by their size and modification time like make does -
+  # missing files are part of the digest, too
+  h = hashlib.sha1()
+
+  for value in values:
+    h.update(repr(value))
+    h.update('\0')
+
+  for path in files:
+    try:
+      st = os.stat(path)
+      h.update('%s:%d:%d\0' % (path, st.st_size, int(st.st_mtime)))
+
+    except OSError:
+      h.update('%s:-\0' % path)
+
+  return h.hexdigest()
+
+
+
+class StepManifest(object):
+  # Records the digest of the inputs and the outputs of every step of an
+  # assembly - a step is up to date if its inputs did not change since its last
+  # successful run and all of its outputs still exist
+
+  def __init__(self, path):
+    self.__path = path
+
+    try:
+      with open(path, 'rb') as f:
+        self.__steps = json.load(f)
+
+    except (IOError, ValueError):
+      self.__steps = {}
+
+
+  @property
+  def path(self):
+    return self.__path
+
+
+  def unchanged(self, name, digest):
+    step = self.__steps.get(name)
+
+    if step is None or step['digest'] != digest:
+      return False
+
+    return all(os.path.lexists(path)
+               for path
+               in step['outputs'])
+
+
+  def record(self, name, digest, outputs = ()):
+    self.__steps[name] = {'digest' : digest,
+                          'outputs' : list(outputs)}
+
+    with replacing(self.path) as f:
+      json.dump(self.__steps, f)
@@ -1,6 +1,7 @@
 from abc import ABCMeta, abstractmethod
 
 import inspect
+import itertools
 import threading
 import collections
 import pkg_resources
@@ -9,6 +10,7 @@ import contextlib
 import traceback
 import time
 import os
+import sys
 import sh
 
 
@@ -24,6 +26,35 @@ def saveiter(thing):
 
 
 
+def concurrently(tasks):
+  # Runs the tasks in threads of their own and raises the first failure after
+  # all of them finished
+  failures = []
+
+  def call(task):
+    try:
+      task()
+
+    except Exception:
+      failures.append(sys.exc_info())
+
+  threads = [threading.Thread(target = call,
+                              args = (task,))
+             for task
+             in tasks]
+
+  for thread in threads:
+    thread.start()
+
+  for thread in threads:
+    thread.join()
+
+  if failures:
+    t, v, tb = failures[0]
+    raise t, v, tb
+
+
+
 def find_tasks(entry_point_group):
   for entry_point in pkg_resources.iter_entry_points(group = entry_point_group):
     taskcls = entry_point.load()
@@ -78,6 +109,11 @@ JobState.Running.antecedent = [type(None),
                                JobState.Checking,
                                JobState.PreRunning]
 
+JobState.Retrying = type('Retrying', (ActiveJobState,), {})
+JobState.Retrying.antecedent = [JobState.Running]
+
+JobState.Running.antecedent.append(JobState.Retrying)
+
 JobState.PostRunning = type('PostRunning', (ActiveJobState,), {})
 JobState.PostRunning.antecedent = [JobState.Running]
 
@@ -92,6 +128,7 @@ JobState.Failed = type('Failed', (FinishedJobState,), {})
 JobState.Failed.antecedent = [JobState.Checking,
                               JobState.PreRunning,
                               JobState.Running,
+                              JobState.Retrying,
                               JobState.PostRunning]
 
 
@@ -198,11 +235,35 @@ class Job(object):
 
 
 
+class TaskFailed(Exception):
+  # Raised by tasks to fail with the given message
+  pass
+
+
+
+class JobFailed(Exception):
+  # Raised after a job has failed to fail its parents, too
+  def __init__(self, job):
+    Exception.__init__(self, job.title)
+
+    self.job = job
+
+
+
 @contextlib.contextmanager
 def job_exception_handler(job):
   try:
     yield
 
+  except JobFailed as ex:
+    message = 'Failed: %s' % ex.job.title
+
+    if ex.job.element is not None:
+      message += ': %s' % ex.job.element
+
+  except TaskFailed as ex:
+    message = str(ex)
+
   except sh.ErrorReturnCode as ex:
     if ex.stderr:
       message = ex.stderr[:-1]
@@ -213,12 +274,19 @@ def job_exception_handler(job):
     else:
       message = traceback.format_exc()
 
-    job.state = JobState.Failed(message.decode('utf-8'))
+    message = message.decode('utf-8')
 
   except Exception:
     message = traceback.format_exc()
 
-    job.state = JobState.Failed(message.decode('utf-8'))
+    message = message.decode('utf-8')
+
+  else:
+    return
+
+  job.state = JobState.Failed(message)
+
+  raise JobFailed(job)
 
 
 
@@ -257,6 +325,10 @@ class JobManager(threading.Thread):
                        terminal.cyan('>>') + terminal.bold_cyan('>>'),
                        terminal.cyan('>>>') + terminal.bold_cyan('>')],
 
+    JobState.Retrying: [terminal.bold_magenta('<') + terminal.magenta('<< '),
+                        terminal.magenta('<') + terminal.bold_magenta('<') + terminal.magenta('< '),
+                        terminal.magenta('<<') + terminal.bold_magenta('< ')],
+
     JobState.PostRunning: [terminal.bold_cyan(' >') + terminal.cyan('>>'),
                            terminal.bold_cyan(' >>') + terminal.cyan('>'),
                            terminal.cyan(' >') + terminal.bold_cyan('>>'),
@@ -378,8 +450,13 @@ class JobManager(threading.Thread):
         # Job failed
         self.__print_backlog(updated_job)
 
-        # Hard exiting of the process
-        os._exit(1)
+
+  def abort(self):
+    # Hard exiting of the process
+    with terminal_lock:
+      terminal.stream.flush()
+
+    os._exit(1)
 
 
   def run(self):
@@ -400,6 +477,13 @@ job_manager = JobManager.instance = JobManager()
 class Task(Job):
   __metaclass__ = ABCMeta
 
+  # The policy to retry failed runs of the task with - see
+  # dazzle.policy.RetryPolicy
+  retry = None
+
+  # Whether the pre and post tasks are independent and run concurrently
+  concurrent = False
+
 
   def __init__(self,
                parent,
@@ -430,6 +514,48 @@ class Task(Job):
     pass
 
 
+  @property
+  def leased(self):
+    # Pre and post tasks are skipped while the resources of the task are held
+    # beyond a single invocation
+    return False
+
+
+  def retrying(self, ex, attempt):
+    # Returns the delay before the next attempt if the exception raised by the
+    # given attempt should be retried, otherwise None
+    if (self.retry is None or
+        isinstance(ex, JobFailed) or
+        attempt >= self.retry.attempts or
+        not self.retry.retryable(ex)):
+      return None
+
+    delay = self.retry.delay(attempt)
+
+    self.state = JobState.Retrying()
+    self.progress = 'Retry %d / %d in %.1f s' % (attempt + 1,
+                                                 self.retry.attempts,
+                                                 delay)
+
+    return delay
+
+
+  def __run(self):
+    for attempt in itertools.count(1):
+      try:
+        return self.run()
+
+      except Exception as ex:
+        delay = self.retrying(ex, attempt)
+
+        if delay is None:
+          raise
+
+      time.sleep(delay)
+
+      self.state = JobState.Running()
+
+
   def __call__(self):
     with job_exception_handler(self):
 
@@ -441,24 +567,34 @@ class Task(Job):
         self.state = JobState.Skipped(excuse)
         return
 
-      # Run pre task(s)
+      # Run pre task(s) unless the resources are held already
+      leased = self.leased
+
       pre = self.pre
-      if pre is not None:
+      if pre is not None and not leased:
         self.state = JobState.PreRunning()
-        for task in saveiter(pre):
-          task()
+        if self.concurrent:
+          concurrently(saveiter(pre))
+
+        else:
+          for task in saveiter(pre):
+            task()
 
       # Run the task if it's required
       if excuse is None:
         self.state = JobState.Running()
-        message = self.run()
+        message = self.__run()
 
       # Run post task(s)
       post = self.post
-      if post is not None:
+      if post is not None and not leased:
         self.state = JobState.PostRunning()
-        for task in saveiter(post):
-          task()
+        if self.concurrent:
+          concurrently(saveiter(post))
+
+        else:
+          for task in saveiter(post):
+            task()
 
       # Update the status
       self.state = JobState.Success(message)
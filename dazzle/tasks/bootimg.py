@@ -1,12 +1,19 @@
 from abc import abstractmethod, abstractproperty
 
-from dazzle.task import Task, job, JobState
+from dazzle.task import Task, TaskFailed, job, JobState
+from dazzle.policy import RetryPolicy
+from dazzle.buildcache import build_cache
+from dazzle.jobserver import jobserver
+from dazzle.download import download_cache, UnpinnedError
+from dazzle.elf import Resolver, is_elf
+from dazzle import cpio, staging, steps, footprint, qemu, ready
 from dazzle.utils import *
 from dazzle.commands import *
 
-import urllib
-import itertools
-import re
+import subprocess
+import hashlib
+import inspect
+import socket
 
 
 
@@ -19,11 +26,24 @@ class AssembleTask(Task):
                parent,
                project,
                target,
-               workspace = None):
+               workspace = None,
+               jobs = None,
+               mirror = None,
+               trust_downloads = False):
     Task.__init__(self,
                   parent = parent,
                   element = None)
 
+    # All builds share the job slots and the downloads of the process
+    if jobs:
+      jobserver.slots = jobs
+
+    if mirror:
+      download_cache.mirror = mirror
+
+    if trust_downloads:
+      download_cache.trust = True
+
     self.__project = project
 
     self.__target = target
@@ -84,6 +104,26 @@ class AssembleTask(Task):
                         default = None,
                         type = str,
                         help = 'reuse an existing build environment')
+    parser.add_argument('-j', '--jobs',
+                        dest = 'jobs',
+                        metavar = 'N',
+                        default = None,
+                        type = positive(int),
+                        help = 'the number of jobs to run concurrently for '
+                               'all builds - defaults to the number of CPUs')
+    parser.add_argument('--mirror',
+                        dest = 'mirror',
+                        metavar = 'DIR',
+                        default = None,
+                        type = str,
+                        help = 'take source archives from DIR instead of '
+                               'downloading them')
+    parser.add_argument('--trust-downloads',
+                        dest = 'trust_downloads',
+                        action = 'store_true',
+                        default = False,
+                        help = 'accept source archives without a pinned '
+                               'checksum and trust their first download')
 
 
 
@@ -105,98 +145,280 @@ class BuildSubTask(Task):
 
 
 
-class DownloadTask(BuildSubTask):
+class FetchTask(BuildSubTask):
+
+  # Mirrors drop connections every now and then
+  retry = RetryPolicy(attempts = 3,
+                      delay = 2.0,
+                      exceptions = (IOError,))
+
   def __init__(self,
                build):
     BuildSubTask.__init__(self,
                           build = build,
-                          title = 'Download %s source' % build.project)
+                          title = 'Fetch %s source' % build.project)
+
 
-    self.__archive_file, _ = build.archive
+  def run(self):
+    def report(received, size):
+      if size:
+        self.progress = '%05.2f %%' % round(float(received) * 100.0 / float(size), 2)
 
+    _, archive_type = self.build.archive
 
-  def check(self):
-    if self.build.mudlark and os.path.exists(mkpath(self.build.workdir, self.__archive_file)):
-      return 'Using existing file: %s' % mkpath(self.build.workdir, self.__archive_file)
+    # Start over with a clean tree on retries
+    rmtree(self.build.workdir_src, ignore_errors = True)
+    mkdir(self.build.workdir_src)
+
+    # Extract the archive while it is downloaded - the cached copy is written
+    # at the same time
+    tar = subprocess.Popen(['tar',
+                            '--extract',
+                            '--strip-components=1',
+                            '--%s' % archive_type,
+                            '--directory', self.build.workdir_src],
+                           stdin = subprocess.PIPE,
+                           stdout = self.build.log,
+                           stderr = self.build.log)
+
+    try:
+      download_cache.fetch(url = self.build.url,
+                           checksum = self.build.checksum,
+                           report = report,
+                           sink = tar.stdin.write)
+
+    except UnpinnedError as e:
+      raise TaskFailed('%s - pin its checksum or pass --trust-downloads' % e)
+
+    finally:
+      tar.stdin.close()
+
+      if tar.wait() != 0:
+        raise IOError('Extracting %s failed' % self.build.project)
+
+
+
+class CompileTask(BuildSubTask):
+  def __init__(self,
+               build):
+    BuildSubTask.__init__(self,
+                          build = build,
+                          title = 'Compile %s' % build.project)
 
 
   def run(self):
-    def report(blocknum, blocksize, size):
-      self.progress = '%05.2f %%' % round(float(blocknum * blocksize) * 100.0 / float(size), 2)
+    self.build.compile(self)
+
+
+
+class InstallTask(BuildSubTask):
+  def __init__(self,
+               build):
+    BuildSubTask.__init__(self,
+                          build = build,
+                          title = 'Install %s' % build.project)
+
 
-    urllib.urlretrieve(url = self.build.url,
-                       filename = self.__archive_file,
-                       reporthook = report)
+  def run(self):
+    self.build.install(self)
 
 
 
-class ExtractTask(BuildSubTask):
+class MinimizeTask(BuildSubTask):
   def __init__(self,
                build):
     BuildSubTask.__init__(self,
                           build = build,
-                  title = 'Extract %s source' % build.project)
+                          title = 'Minimize %s' % build.project)
+
 
-    self.__archive_file, self.__archive_type = build.archive
+  def check(self):
+    if not self.build.minimizing:
+      return 'Minimizing is disabled'
 
 
   def run(self):
-    def report(line):
-      self.progress = '%s %%' % int(line.strip())
+    return self.build.minimize(self)
+
+
 
-    sh.tar(sh.pv(self.__archive_file,
-                 '-n',
-                 _piped = True,
-                 _err = report),
-           '--strip-components=1',
-           '--%s' % self.__archive_type,
-           extract = True,
-           verbose = True,
-           directory = self.build.workdir_src,
-           _out = self.build.log)
+class RestoreTask(BuildSubTask):
+  def __init__(self,
+               build,
+               artifact):
+    BuildSubTask.__init__(self,
+                          build = build,
+                          title = 'Restore %s from cache' % build.project)
 
+    self.__artifact = artifact
 
 
-class CompileTask(BuildSubTask):
+  def run(self):
+    for name in self.build.cached:
+      build_cache.restore(self.__artifact,
+                          name = name,
+                          target = mkpath(self.build.workdir, name))
+
+    build_cache.restore(self.__artifact,
+                        name = 'root',
+                        target = self.build.target)
+
+
+
+class StoreTask(BuildSubTask):
   def __init__(self,
                build):
     BuildSubTask.__init__(self,
                           build = build,
-                          title = 'Compile %s' % build.project)
+                          title = 'Store %s in cache' % build.project)
+
+
+  def check(self):
+    if not build_cache.enabled:
+      return 'Build cache is disabled'
 
 
   def run(self):
-    self.build.compile(self)
+    trees = {name : mkpath(self.build.workdir, name)
+             for name
+             in self.build.cached}
+    trees['root'] = self.build.target
 
+    build_cache.store(self.build.project,
+                      key = self.build.key,
+                      trees = trees)
 
 
-class InstallTask(BuildSubTask):
+
+class StepTask(BuildSubTask):
+  # A step of the assembly which is skipped if its inputs are unchanged since
+  # its last successful run - the action may add the outputs it created
+
   def __init__(self,
-               build):
+               build,
+               title,
+               action,
+               values = (),
+               files = (),
+               outputs = ()):
     BuildSubTask.__init__(self,
                           build = build,
-                          title = 'Install %s' % build.project)
+                          title = title)
+
+    self.__action = action
+
+    self.__digest = steps.digest(values = values,
+                                 files = files)
+
+    self.__outputs = list(outputs)
+
+
+  @property
+  def digest(self):
+    return self.__digest
+
+
+  @property
+  def outputs(self):
+    return self.__outputs
+
+
+  def check(self):
+    if self.build.steps.unchanged(self.title, self.digest):
+      return 'Inputs unchanged'
 
 
   def run(self):
-    self.build.install(self)
+    message = self.__action(self)
+
+    self.build.steps.record(self.title,
+                            digest = self.digest,
+                            outputs = self.outputs)
+
+    return message
 
 
 
 class BuildTask(AssembleTask):
 
+  # The resources used to build and install the project
+  resources = []
+
+  # The paths of the work directory required after the installation which are
+  # cached alongside the installed files
+  cached = []
+
+  # The checksum of the source archive as 'ALGORITHM:HEX' - archives without
+  # one are only built if downloads are trusted
+  checksum = None
+
   def __init__(self,
                parent,
                project,
-               workspace):
+               workspace,
+               jobs = None,
+               mirror = None,
+               trust_downloads = False,
+               strip = False):
+    self.__image = parent.workdir
+
+    self.__strip = strip
+
     AssembleTask.__init__(self,
                        parent = parent,
                        project = project,
-                       target = parent.workdir,
-                       workspace = workspace)
+                       target = None,
+                       workspace = workspace,
+                       jobs = jobs,
+                       mirror = mirror,
+                       trust_downloads = trust_downloads)
 
     self.__workdir_src = mkpath(self.workdir, 'src')
     self.__workdir_dst = mkpath(self.workdir, 'dst')
+    self.__workdir_root = mkpath(self.workdir, 'root')
+
+
+  @property
+  def strip(self):
+    return self.__strip
+
+
+  @property
+  def variant(self):
+    # The options changing the installed files
+    return [self.strip]
+
+
+  @property
+  def minimizing(self):
+    return self.strip
+
+
+  @property
+  def target(self):
+    # The project is installed into a private root which is cached and merged
+    # into the image afterwards
+    return self.__workdir_root
+
+
+  @property
+  def key(self):
+    # The artifact depends on the source, the used resources and the build
+    # recipe itself
+    digest = hashlib.sha1()
+    digest.update(self.url)
+
+    for name in sorted(self.resources):
+      with open(resource(name), 'rb') as f:
+        digest.update(name)
+        digest.update(f.read())
+
+    for method in (self.compile, self.install, self.minimize):
+      digest.update(inspect.getsource(method))
+
+    digest.update(repr(self.variant))
+
+    return digest.hexdigest()
 
 
   @property
@@ -235,83 +457,210 @@ class BuildTask(AssembleTask):
     pass
 
 
+  def minimize(self, j):
+    saved = footprint.strip(self.target)
+
+    return 'Saved %d KiB' % (saved // 1024)
+
+
+  def __current(self, key):
+    # Whether the workspace holds the artifact of the key already
+    try:
+      with open(mkpath(self.workdir, '.key'), 'r') as f:
+        if f.read() != key:
+          return False
+
+    except IOError:
+      return False
+
+    return all(os.path.exists(mkpath(self.workdir, name))
+               for name
+               in self.cached + ['root'])
+
+
   def run(self):
-    mkdir(self.workdir_src)
-    mkdir(self.workdir_dst)
+    key = self.key
 
-    with cd(self.workdir):
-      DownloadTask(build = self)()
-      ExtractTask(build = self)()
-      CompileTask(build = self)()
-      InstallTask(build = self)()
+    if self.__current(key):
+      with job(self, 'Workspace is up to date'):
+        pass
+
+    else:
+      # Forget about the workspace content until it's complete again
+      rm(mkpath(self.workdir, '.key'))
+
+      rmtree(self.target, ignore_errors = True)
+
+      mkdir(self.workdir_src)
+      mkdir(self.workdir_dst)
+      mkdir(self.target)
+
+      artifact = build_cache.lookup(self.project, key)
+
+      # Builds run concurrently - all paths must be absolute as the working
+      # directory is shared by all threads
+      if artifact is not None:
+        RestoreTask(build = self,
+                    artifact = artifact)()
+
+      else:
+        FetchTask(build = self)()
+        CompileTask(build = self)()
+        InstallTask(build = self)()
+        MinimizeTask(build = self)()
+        StoreTask(build = self)()
+
+      with open(mkpath(self.workdir, '.key'), 'w') as f:
+        f.write(key)
+
+    # Merge the installed files into the image - they are private to this
+    # build and may be shared by hardlinks
+    manifest = staging.Manifest(hardlink = True)
+    manifest.tree(self.target)
+    manifest.apply(self.__image)
 
 
 
 class Kernel(BuildTask):
   ''' Download and compile kernel '''
 
+  resources = ['kernel.config']
+
+  def __init__(self,
+               parent,
+               project,
+               workspace,
+               jobs = None,
+               mirror = None,
+               trust_downloads = False,
+               strip = False,
+               modules = None,
+               embed = False):
+    BuildTask.__init__(self,
+                       parent = parent,
+                       project = project,
+                       workspace = workspace,
+                       jobs = jobs,
+                       mirror = mirror,
+                       trust_downloads = trust_downloads,
+                       strip = strip)
+
+    self.__embed = embed
+
+    # The allow-list is part of the build key by its content
+    self.__modules = None
+    self.__allowlist = None
+
+    if modules is not None:
+      self.__modules = os.path.abspath(modules)
+
+      with open(self.__modules, 'r') as f:
+        self.__allowlist = f.read()
+
+
   @property
   def project(self):
     return 'kernel'
 
 
+  @property
+  def cached(self):
+    # Embedding the initramfs relinks the kernel in the build trees - the
+    # plain boot image is sufficient otherwise
+    if self.__embed:
+      return ['src', 'dst']
+
+    return ['dst/arch/x86/boot/bzImage']
+
+
+  @property
+  def variant(self):
+    return BuildTask.variant.fget(self) + [self.__allowlist, self.__embed]
+
+
+  @property
+  def minimizing(self):
+    return self.strip or self.__modules is not None
+
+
   @property
   def url(self):
     return 'https://www.kernel.org/pub/linux/kernel/v3.x/linux-3.11.1.tar.xz'
 
 
   def compile(self, j):
-    with cd(self.workdir_src):
-      if not self.mudlark:
-        sh.make('O=%s' % self.workdir_dst,
-                'clean',
-                _out = self.log)
+    if not self.mudlark:
+      jobserver.make('O=%s' % self.workdir_dst,
+                     'clean',
+                     _cwd = self.workdir_src,
+                     _out = self.log)
 
-      sh.cp(resource('kernel.config'),
-            mkpath(self.workdir_dst, '.config'))
+    sh.cp(resource('kernel.config'),
+          mkpath(self.workdir_dst, '.config'))
 
-      sh.make('O=%s' % self.workdir_dst,
-              'vmlinux',
-              'modules',
-              '-j4',
-              _out = self.log)
+    jobserver.make('O=%s' % self.workdir_dst,
+                   'bzImage',
+                   'modules',
+                   _cwd = self.workdir_src,
+                   _out = self.log)
 
 
   def install(self, j):
-    with cd(self.workdir_src):
-      sh.make('O=%s' % self.workdir_dst,
-              'modules_install',
-              _env = {'INSTALL_MOD_PATH': self.target},
-              _out = self.log)
+    jobserver.make('O=%s' % self.workdir_dst,
+                   'modules_install',
+                   _env = {'INSTALL_MOD_PATH': self.target},
+                   _cwd = self.workdir_src,
+                   _out = self.log)
+
+
+  def minimize(self, j):
+    messages = []
+
+    if self.__modules is not None:
+      removed = footprint.prune(self.target,
+                                allowed = footprint.allowlist(self.__modules,
+                                                              source = self.workdir_src))
+
+      messages.append('Removed %d modules' % removed)
+
+    if self.strip:
+      messages.append(BuildTask.minimize(self, j))
+
+    return ', '.join(messages)
+
+
+  def copy(self, target):
+    # The kernel is built along with the modules - it's used as is if the
+    # initramfs is loaded separately
+    cp(mkpath(self.workdir_dst, 'arch/x86/boot/bzImage'),
+       target)
 
 
   def create(self, initramfs, target):
-    with cd(self.workdir_src):
-      sh.make('O=%s' % self.workdir_dst,
-              'bzImage',
-              '-j4',
-              _out = self.log)
+    # Relink the kernel with the initramfs embedded
+    cp(mkpath(self.workdir_dst, 'arch/x86/boot/bzImage'),
+       mkpath(self.workdir_dst, 'arch/x86/boot/bzImage.bak'))
 
-    with cd(self.workdir_dst):
-      cp('arch/x86/boot/bzImage',
-         'arch/x86/boot/bzImage.bak')
+    jobserver.make('O=%s' % self.workdir_dst,
+                   'CONFIG_INITRAMFS_SOURCE=%s' % initramfs,
+                   'bzImage',
+                   _cwd = self.workdir_src,
+                   _out = self.log)
 
-    with cd(self.workdir_src):
-      sh.make('O=%s' % self.workdir_dst,
-              'CONFIG_INITRAMFS_SOURCE=%s' % initramfs,
-              'bzImage',
-              '-j4',
-              _out = self.log)
+    cp(mkpath(self.workdir_dst, 'arch/x86_64/boot/bzImage'),
+       target)
 
-    with cd(self.workdir_dst):
-      cp('arch/x86_64/boot/bzImage',
-         target)
+    # Keep the plain kernel around for external initramfs images
+    cp(mkpath(self.workdir_dst, 'arch/x86/boot/bzImage.bak'),
+       mkpath(self.workdir_dst, 'arch/x86/boot/bzImage'))
 
 
 
 class Busybox(BuildTask):
   ''' Download and build busybox '''
 
+  resources = ['busybox.config', 'udhcpc']
+
   @property
   def project(self):
     return 'busybox'
@@ -323,31 +672,31 @@ class Busybox(BuildTask):
 
 
   def compile(self, j):
-    with cd(self.workdir_src):
-      if not self.mudlark:
-        sh.make('O=%s' % self.workdir_dst,
-                'clean',
-                _out = self.log)
+    if not self.mudlark:
+      jobserver.make('O=%s' % self.workdir_dst,
+                     'clean',
+                     _cwd = self.workdir_src,
+                     _out = self.log)
 
-      sh.cp(resource('busybox.config'),
-            mkpath(self.workdir_dst, '.config'))
+    sh.cp(resource('busybox.config'),
+          mkpath(self.workdir_dst, '.config'))
 
-      sh.make('O=%s' % self.workdir_dst,
-              'busybox',
-              '-j4',
-              _out = self.log)
+    jobserver.make('O=%s' % self.workdir_dst,
+                   'busybox',
+                   _cwd = self.workdir_src,
+                   _out = self.log)
 
 
   def install(self, j):
-    with cd(self.workdir_src):
-      sh.make('O=%s' % self.workdir_dst,
-              'CONFIG_PREFIX=%s' % self.target,
-              'install',
-              _out = self.log)
+    jobserver.make('O=%s' % self.workdir_dst,
+                   'CONFIG_PREFIX=%s' % self.target,
+                   'install',
+                   _cwd = self.workdir_src,
+                   _out = self.log)
 
-    with cd(self.target):
-      mkdir('etc/udhcpc/')
-      cp_script(resource('udhcpc'), 'etc/udhcpc/default.script')
+    mkdir(mkpath(self.target, 'etc/udhcpc/'))
+    cp_script(resource('udhcpc'),
+              mkpath(self.target, 'etc/udhcpc/default.script'))
 
 
 
@@ -365,52 +714,52 @@ class Dropbear(BuildTask):
 
 
   def compile(self, j):
-    with cd(self.workdir_dst):
-      sh.sh('%s/configure' % self.workdir_src,
-            '--prefix', '/usr',
-            '--disable-zlib',
-            '--enable-bundled-libtom',
-            _out = self.log)
-
-      if not self.mudlark:
-        sh.make('thisclean',
-                _out = self.log)
-
-      with cd(self.workdir_src):
-        sh.sed('-i',
-               's' \
-               '|#define DEFAULT_PATH "/usr/bin:/bin"' \
-               '|#define DEFAULT_PATH "/usr/sbin:/sbin:/usr/bin:/bin"' \
-               '|g',
-               'options.h')
-
-      sh.make('all',
-              '-j4',
-              _out = self.log)
+    sh.sh('%s/configure' % self.workdir_src,
+          '--prefix', '/usr',
+          '--disable-zlib',
+          '--enable-bundled-libtom',
+          _cwd = self.workdir_dst,
+          _out = self.log)
+
+    if not self.mudlark:
+      jobserver.make('thisclean',
+                     _cwd = self.workdir_dst,
+                     _out = self.log)
+
+    sh.sed('-i',
+           's' \
+           '|#define DEFAULT_PATH "/usr/bin:/bin"' \
+           '|#define DEFAULT_PATH "/usr/sbin:/sbin:/usr/bin:/bin"' \
+           '|g',
+           mkpath(self.workdir_src, 'options.h'))
+
+    jobserver.make('all',
+                   _cwd = self.workdir_dst,
+                   _out = self.log)
 
 
   def install(self, j):
-    with cd(self.workdir_dst):
-      sh.make('install',
-              'DESTDIR=%s' % self.target,
-              _out = self.log)
+    jobserver.make('install',
+                   'DESTDIR=%s' % self.target,
+                   _cwd = self.workdir_dst,
+                   _out = self.log)
 
     with job(self, 'Create host keys'):
-      with cd(self.target):
-        # Generate host keys
-        mkdir('etc/dropbear/')
+      # Generate host keys
+      keys = mkpath(self.target, 'etc/dropbear/')
+      mkdir(keys)
 
-        dropbearkey = sh.Command(mkpath(self.workdir_dst, 'dropbearkey'))
+      dropbearkey = sh.Command(mkpath(self.workdir_dst, 'dropbearkey'))
 
-        rm('etc/dropbear/dropbear_rsa_host_key')
-        dropbearkey('-t', 'rsa',
-                    '-f', 'etc/dropbear/dropbear_rsa_host_key',
-                    _out = self.log)
+      rm(mkpath(keys, 'dropbear_rsa_host_key'))
+      dropbearkey('-t', 'rsa',
+                  '-f', mkpath(keys, 'dropbear_rsa_host_key'),
+                  _out = self.log)
 
-        rm('etc/dropbear/dropbear_dss_host_key')
-        dropbearkey('-t', 'dss',
-                    '-f', 'etc/dropbear/dropbear_dss_host_key',
-                    _out = self.log)
+      rm(mkpath(keys, 'dropbear_dss_host_key'))
+      dropbearkey('-t', 'dss',
+                  '-f', mkpath(keys, 'dropbear_dss_host_key'),
+                  _out = self.log)
 
 
 class LZOPUtils(BuildTask):
@@ -427,28 +776,28 @@ class LZOPUtils(BuildTask):
 
 
   def compile(self, j):
-    with cd(self.workdir_dst):
-      sh.sh('%s/configure' % self.workdir_src,
-            '--prefix', '/usr',
-            _out = self.log)
+    sh.sh('%s/configure' % self.workdir_src,
+          '--prefix', '/usr',
+          _cwd = self.workdir_dst,
+          _out = self.log)
 
-      if not self.mudlark:
-        sh.make('clean',
-                _out = self.log)
+    if not self.mudlark:
+      jobserver.make('clean',
+                     _cwd = self.workdir_dst,
+                     _out = self.log)
 
-      sh.make('all',
-              '-j4',
-              _out = self.log)
+    jobserver.make('all',
+                   _cwd = self.workdir_dst,
+                   _out = self.log)
 
 
   def install(self, j):
-    with cd(self.workdir_dst):
-      # We don't need most of the stuff lzop would install - so do it manually
-      sh.install('-d',
-                 mkpath(self.target, 'usr/bin'))
-      sh.install('-m755',
-                 'src/lzop',
-                 mkpath(self.target, 'usr/bin'))
+    # We don't need most of the stuff lzop would install - so do it manually
+    sh.install('-d',
+               mkpath(self.target, 'usr/bin'))
+    sh.install('-m755',
+               mkpath(self.workdir_dst, 'src/lzop'),
+               mkpath(self.target, 'usr/bin'))
 
 
 
@@ -460,96 +809,105 @@ class UDPCast(BuildTask):
     return 'udpcast'
 
 
+  checksum = 'md5:b9b67a577ca5659a93bcb9e43f298fb2'
+
   @property
   def url(self):
     return 'http://pkgs.fedoraproject.org/repo/pkgs/udpcast/udpcast-20120424.tar.gz/b9b67a577ca5659a93bcb9e43f298fb2/udpcast-20120424.tar.gz'
 
 
   def compile(self, j):
-    with cd(self.workdir_dst):
-      sh.sh('%s/configure' % self.workdir_src,
-            '--prefix', '/usr',
-            _out = self.log)
+    sh.sh('%s/configure' % self.workdir_src,
+          '--prefix', '/usr',
+          _cwd = self.workdir_dst,
+          _out = self.log)
 
-      if not self.mudlark:
-        sh.make('clean',
-                _out = self.log)
+    if not self.mudlark:
+      jobserver.make('clean',
+                     _cwd = self.workdir_dst,
+                     _out = self.log)
 
-      sh.make('all',
-              '-j4',
-              _out = self.log)
+    jobserver.make('all',
+                   _cwd = self.workdir_dst,
+                   _out = self.log)
 
 
   def install(self, j):
-    with cd(self.workdir_dst):
-      # Can't use the standard make install because of a bug during out of tree
-      # builds - copy the two programs manually
-      # sh.make('install',
-      #         'DESTDIR=%s' % self.target,
-      #         _out = self.log)
-      sh.install('-d',
-                 mkpath(self.target, 'usr/sbin'))
-      sh.install('-m755',
-                 'udp-sender',
-                 'udp-receiver',
-                 mkpath(self.target, 'usr/sbin'))
+    # Can't use the standard make install because of a bug during out of tree
+    # builds - copy the two programs manually
+    # sh.make('install',
+    #         'DESTDIR=%s' % self.target,
+    #         _out = self.log)
+    sh.install('-d',
+               mkpath(self.target, 'usr/sbin'))
+    sh.install('-m755',
+               mkpath(self.workdir_dst, 'udp-sender'),
+               mkpath(self.workdir_dst, 'udp-receiver'),
+               mkpath(self.target, 'usr/sbin'))
 
 
 
 class Image(AssembleTask):
   ''' Create maintenance boot image '''
 
-  ldconfig_re = re.compile(r'''
-    ^
-    \s+
-    (?P<name>
-      libnss_(files
-             |dns
-             ).so.2
-    )
-    \ \((?P<spec>
-      .*
-    )\)
-    \ =>
-    \ (?P<path>
-      .+
-    )
-    $
-  ''', re.VERBOSE)
-
-  ldd_re = re.compile(r'''
-    ^
-    \s+(
-      linux-(vdso|gate).so.1
-    |
-      (
-        (\S+\ =>\ )?
-        (?P<path>/\S+)
-      )
-    )
-    \ \(0x[0-9a-f]+\)
-    $
-  ''', re.VERBOSE)
+  # The components are built independently
+  concurrent = True
+
+  # The initial device nodes - created in the archive only
+  devices = [('dev/mem', 1, 1),
+             ('dev/kmem', 1, 2),
+             ('dev/null', 1, 3),
+             ('dev/port', 1, 4),
+             ('dev/zero', 1, 5),
+             ('dev/full', 1, 7),
+             ('dev/random', 1, 8),
+             ('dev/urandom', 1, 9),
+             ('dev/tty', 5, 0),
+             ('dev/console', 5, 1)]
+
+  # The name service libraries loaded at runtime
+  nss = ['libnss_files.so.2',
+         'libnss_dns.so.2']
 
 
   def __init__(self,
                parent,
                workspace,
-               target):
+               target,
+               jobs = None,
+               mirror = None,
+               trust_downloads = False,
+               embed = False,
+               tftp_root = '/srv/tftp',
+               compression = 'gzip',
+               strip = False,
+               modules = None,
+               benchmark = 0):
     AssembleTask.__init__(self,
                        parent = parent,
                        project = 'image',
                        target = target,
-                       workspace = workspace)
-
-    self.__kernel = Kernel(parent = self, project = 'kernel', workspace = workspace)
-    self.__busybox = Busybox(parent = self, project = 'busybox', workspace = workspace)
-    self.__dropbear = Dropbear(parent = self, project = 'dropear', workspace = workspace)
-    self.__lzoputils = LZOPUtils(parent = self, project = 'xz', workspace = workspace)
-    self.__udpcast = UDPCast(parent = self, project = 'udpcast', workspace = workspace)
+                       workspace = workspace,
+                       jobs = jobs,
+                       mirror = mirror,
+                       trust_downloads = trust_downloads)
+
+    self.__embed = embed
+    self.__tftp_root = tftp_root
+    self.__compression = compression
+    self.__benchmark = benchmark
+
+    self.__kernel = Kernel(parent = self, project = 'kernel', workspace = workspace, strip = strip, modules = modules, embed = embed)
+    self.__busybox = Busybox(parent = self, project = 'busybox', workspace = workspace, strip = strip)
+    self.__dropbear = Dropbear(parent = self, project = 'dropear', workspace = workspace, strip = strip)
+    self.__lzoputils = LZOPUtils(parent = self, project = 'xz', workspace = workspace, strip = strip)
+    self.__udpcast = UDPCast(parent = self, project = 'udpcast', workspace = workspace, strip = strip)
 
     self.__target = target
 
+    # The digests of the steps of the last assemblies in the workspace
+    self.__steps = steps.StepManifest(mkpath(self.workdir, 'steps.json'))
+
 
   @property
   def target(self):
@@ -561,6 +919,11 @@ class Image(AssembleTask):
     return 'image'
 
 
+  @property
+  def steps(self):
+    return self.__steps
+
+
   @property
   def pre(self):
     return [self.__kernel,
@@ -570,129 +933,384 @@ class Image(AssembleTask):
             self.__lzoputils]
 
 
+  def __stage(self, title, manifest, values = ()):
+    # Stages the entries of the manifest at once - the step depends on the
+    # entries and the files they are copied from
+    def action(step):
+      def report(done, total):
+        step.progress = '%d / %d' % (done, total)
+
+      changed = manifest.apply(self.workdir,
+                               report = report)
+
+      return '%d of %d entries changed' % (changed, len(manifest))
+
+    step = StepTask(build = self,
+                    title = title,
+                    action = action,
+                    values = [manifest.digest()] + list(values),
+                    outputs = [mkpath(self.workdir, path)
+                               for path
+                               in manifest.paths])
+    step()
+
+    return step.digest
+
+
   def run(self):
+    resolver = Resolver()
+
+    # The components are merged into the tree already - the archive depends on
+    # them and on every step
+    keys = [component.key for component in self.pre]
+    digests = list(keys)
+
     with cd(self.workdir):
 
-      if not self.mudlark:
-        rm('*')
-
-      with job(self, 'Create base layout'):
-        for d in [
-            'etc',
-            'dev', 'dev/pts',
-            'var', 'var/run',
-            'lib',
-            'proc',
-            'sys',
-            'tmp'
-        ]: mkdir(d)
-
-        # Create initial device nodes
-        for name, major, minor in [
-            ('mem    ', 1, 1),
-            ('kmem   ', 1, 2),
-            ('null   ', 1, 3),
-            ('port   ', 1, 4),
-            ('zero   ', 1, 5),
-            ('full   ', 1, 7),
-            ('random ', 1, 8),
-            ('urandom', 1, 9),
-            ('tty    ', 5, 0),
-            ('console', 5, 1),
-        ]:
-          path = mkpath('dev', name)
-          rm(path)
-          sh.mknod(path,
-                   'c',
-                   major,
-                   minor)
-
-      with job(self, 'Copy NSS libraries'):
-        libs = []
-        for line in sh.Command('/sbin/ldconfig')('-p'):
-          lib = self.ldconfig_re.match(line)
-          if lib:
-            libs.append(lib.groupdict())
-
-        for lib in (sorted(libs, key = lambda lib: len(lib['spec'].split(',')))[-1]
-                    for _, libs
-                    in itertools.groupby(libs, lambda lib: lib['name'])):
-          cp_lib(lib['path'],
-                 self.workdir)
-
-      with job(self, 'Create root user'):
-        with open('etc/passwd', 'w') as f:
-          f.write('root::0:0:root:/root:/bin/sh\n')
-
-        with open('etc/group', 'w') as f:
-          f.write('root::0:root\n')
-
-        mkdir('root/')
-        mkdir('root/.ssh/')
+      layout = staging.Manifest()
+      for d in [
+          'etc',
+          'dev', 'dev/pts',
+          'var', 'var/run',
+          'lib',
+          'proc',
+          'sys',
+          'tmp'
+      ]: layout.directory(d)
+
+      digests.append(self.__stage('Create base layout', layout))
+
+      # The libraries are loaded at runtime - look them up for busybox
+      nss = []
+      for name in self.nss:
+        lib = resolver.lookup(name,
+                              reference = mkpath(self.workdir, 'bin/busybox'))
+
+        if lib is None:
+          raise TaskFailed('Can not find NSS library: %s' % name)
 
+        nss.append(lib)
+
+      libraries = staging.Manifest()
+      for lib in nss:
+        libraries.file(lib, lib)
+
+      digests.append(self.__stage('Copy NSS libraries', libraries))
+
+      user = staging.Manifest()
+      user.content('etc/passwd',
+                   'root::0:0:root:/root:/bin/sh\n')
+
+      user.content('etc/group',
+                   'root::0:root\n')
+
+      user.directory('root/')
+      user.directory('root/.ssh/')
+
+      for key in ['/root/.ssh/id_dsa.pub',
+                  '/root/.ssh/id_rsa.pub']:
+        if os.path.exists(key):
+          user.file('root/.ssh/authorized_keys', key,
+                    mode = 0600)
+          break
+
+      else:
+        raise TaskFailed('No public key found for the root user')
+
+      digests.append(self.__stage('Create root user', user))
+
+      config = staging.Manifest()
+      config.file('etc/nsswitch.conf',
+                  resource('nsswitch.conf'))
+
+      digests.append(self.__stage('Copy system config files', config))
+
+      scripts = staging.Manifest()
+      scripts.link('init', 'bin/busybox')
+      scripts.link('sh', 'bin/busybox')
+
+      scripts.directory('etc/init.d/')
+      scripts.file('etc/init.d/rcS',
+                   resource('rcS'),
+                   mode = 0755)
+
+      scripts.file('etc/inittab',
+                   resource('inittab'),
+                   mode = 0755)
+
+      # The links must follow a rebuilt busybox
+      digests.append(self.__stage('Configure boot scripts', scripts,
+                                  values = [self.__busybox.key]))
+
+      # Without the announcement, hosts are polled until they are up
+      StepTask(build = self,
+               title = 'Check ready announcement',
+               action = lambda step: self.announce(),
+               values = [self.__busybox.key])()
+
+      def required(step):
+        # Libraries are resolved once for all objects and copied once
+        objects = list(nss)
+        for path, _, files in os.walk(self.workdir):
+          for name in files:
+            name = mkpath(path, name)
+
+            if (not os.path.islink(name) and
+                os.access(name, os.X_OK) and
+                is_elf(name)):
+              objects.append(name)
+
+        manifest = staging.Manifest()
+        for lib in sorted(resolver.libraries(objects)):
+          manifest.file(lib, lib)
+
+        changed = manifest.apply(self.workdir)
+
+        step.outputs.extend(mkpath(self.workdir, path)
+                            for path
+                            in manifest.paths)
+
+        return '%d of %d entries changed' % (changed, len(manifest))
+
+      # The libraries depend on the executables of the components and the
+      # libraries of the host
+      step = StepTask(build = self,
+                      title = 'Copy required libraries',
+                      action = required,
+                      values = keys,
+                      files = nss + ['/etc/ld.so.cache'])
+      step()
+
+      digests.append(step.digest)
+
+      # The kernel compresses embedded archives on its own
+      if self.__embed:
+        initramfs = mkpath(self.workdir, 'initramfs.cpio')
+        compression = 'none'
+
+      else:
+        initramfs = self.initrd
+        compression = self.__compression
+
+      def archive(step):
+        cpio.archive(self.workdir,
+                     initramfs,
+                     compression = compression,
+                     devices = self.devices,
+                     exclude = ['initramfs.cpio', 'log', 'steps.json'])
+
+      step = StepTask(build = self,
+                      title = 'Create initamfs archive',
+                      action = archive,
+                      values = digests + [initramfs,
+                                          compression,
+                                          self.devices],
+                      outputs = [initramfs])
+      step()
+
+      if self.__embed:
+        StepTask(build = self,
+                 title = 'Assemble boot image',
+                 action = lambda step: self.__kernel.create(initramfs = initramfs,
+                                                            target = self.target),
+                 values = [step.digest, self.__kernel.key, self.target],
+                 outputs = [self.target])()
+
+      else:
+        StepTask(build = self,
+                 title = 'Copy kernel',
+                 action = lambda step: self.__kernel.copy(target = self.target),
+                 values = [self.__kernel.key, self.target],
+                 outputs = [self.target])()
+
+        StepTask(build = self,
+                 title = 'Create pxelinux config',
+                 action = lambda step: self.pxelinux(),
+                 values = [self.target, self.initrd, self.__tftp_root],
+                 outputs = ['%s.cfg' % self.target])()
+
+      with job(self, 'Report image size') as report:
+        self.report(report,
+                    initramfs = None if self.__embed else initramfs)
+
+      if self.__benchmark:
+        with job(self, 'Benchmark boot') as benchmark:
+          self.benchmark(benchmark)
+
+
+  def report(self, report, initramfs):
+    # Files are accounted to the component installing them - all other files
+    # are copied from the host or created for the image
+    owners = {}
+    for component in self.pre:
+      for path, _, files in os.walk(component.target):
+        for name in files:
+          name = os.path.relpath(mkpath(path, name), component.target)
+          owners[name] = component.project
+
+    def owner(path):
+      if path in owners:
+        return owners[path]
+
+      if is_elf(mkpath(self.workdir, path)):
+        return 'libraries'
+
+      return 'base'
+
+    sizes = footprint.usage(self.workdir,
+                            owner = owner,
+                            exclude = ['initramfs.cpio', 'log', 'steps.json'])
+
+    sizes = sorted(sizes.items(),
+                   key = lambda item: item[1],
+                   reverse = True)
+
+    # The kernel and the archive are transferred to the machines
+    transferred = [('kernel image', os.path.getsize(self.target))]
+
+    if initramfs is not None:
+      transferred.append(('initramfs', os.path.getsize(initramfs)))
+
+    for name, size in sizes + transferred:
+      self.log.write('%-16s %10d\n' % (name, size))
+
+      with job(report, name) as j:
+        j.state = JobState.Success('%d KiB' % (size // 1024))
+
+    report.state = JobState.Success('%d KiB to transfer' % (sum(size
+                                                                for _, size
+                                                                in transferred) // 1024))
+
+
+  def benchmark(self, benchmark):
+    # The time from starting the kernel until the ssh server is ready is
+    # reported by the image itself
+    uptimes = []
+
+    for run in range(self.__benchmark):
+      with job(benchmark, 'Boot %d' % (run + 1)) as j:
         try:
-          cp('/root/.ssh/id_dsa.pub',
-             'root/.ssh/authorized_keys')
+          uptime, elapsed = qemu.boot(kernel = self.target,
+                                      initrd = None if self.__embed else self.initrd,
+                                      log = self.log)
+
+        except (IOError, OSError) as e:
+          raise TaskFailed('Booting in %s failed: %s' % (qemu.QEMU, e))
+
+        uptimes.append(uptime)
+
+        j.state = JobState.Success('Ready %.2f s after kernel start, %.2f s after launch' % (uptime,
+                                                                                            elapsed))
 
-        except:
-          cp('/root/.ssh/id_rsa.pub',
-             'root/.ssh/authorized_keys')
+    uptimes.sort()
 
-        sh.chmod('0600', 'root/.ssh/authorized_keys')
+    benchmark.state = JobState.Success('Median %.2f s from kernel start to ssh' % uptimes[len(uptimes) // 2])
 
-      with job(self, 'Copy system config files'):
-        cp(resource('nsswitch.conf'),
-           'etc')
 
-      with job(self, 'Configure boot scripts'):
-        ln('bin/busybox', 'init')
-        ln('bin/busybox', 'sh')
+  def announce(self):
+    # Sends an announcement to a local socket the way the boot script does
+    # using the busybox of the image
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', 0))
+    sock.settimeout(5)
 
-        mkdir('etc/init.d/')
-        cp_script(resource('rcS'),
-                  'etc/init.d/rcS')
+    _, port = sock.getsockname()
 
-        cp_script(resource('inittab'),
-                  'etc/inittab')
+    try:
+      nc = subprocess.Popen([mkpath(self.workdir, 'bin/busybox'),
+                             'nc', '-u', '-w', '1', '127.0.0.1', str(port)],
+                            stdin = subprocess.PIPE,
+                            stdout = self.log,
+                            stderr = self.log)
 
-      with job(self, 'Copy required libraries'):
-        for prog in sh.find(self.workdir,
-                            '-type', 'f',
-                            '-executable',
-                            _iter = True):
-          try:
-            for line in sh.ldd(prog[:-1], _iter = True):
-              lib = self.ldd_re.match(line)
-              if lib and lib.group('path'):
-                cp_lib(lib.group('path'),
-                       self.workdir)
+      nc.communicate('dazzle-ready check 00:00:00:00:00:00 127.0.0.1 0.00\n')
 
-          except:
-            pass
+      if nc.returncode != 0:
+        raise TaskFailed('Busybox can not send ready announcements: nc -u '
+                         'exited with %d' % nc.returncode)
 
+      try:
+        data, (address, _) = sock.recvfrom(512)
+        ready.parse(data, address)
 
-      with job(self, 'Create initamfs archive'):
-        initramfs = 'initramfs.cpio'
+      except (socket.error, ValueError) as e:
+        raise TaskFailed('Busybox can not send ready announcements: %s' % e)
 
-        sh.cpio(sh.find('.',
-                        '-not', '-path', './%s' % initramfs,
-                        _piped = True),
-                create = True,
-                format = 'newc',
-                verbose = True,
-                _piped = True,
-                _out = initramfs,
-                _err = self.log)
+    finally:
+      sock.close()
 
-      with job(self, 'Assemble boot image'):
-        self.__kernel.create(initramfs = mkpath(self.workdir, initramfs),
-                             target = self.target)
+
+  @property
+  def initrd(self):
+    return '%s.initrd' % self.target
+
+
+  def pxelinux(self):
+    # The paths in the config are relative to the TFTP root
+    def relative(path):
+      path = os.path.abspath(path)
+
+      if path.startswith(os.path.join(os.path.abspath(self.__tftp_root), '')):
+        return os.path.relpath(path, self.__tftp_root)
+
+      return os.path.basename(path)
+
+    with open('%s.cfg' % self.target, 'w') as f:
+      f.write('DEFAULT maintenance\n'
+              '\n'
+              'LABEL maintenance\n'
+              '  KERNEL %s\n'
+              '  INITRD %s\n' % (relative(self.target),
+                                  relative(self.initrd)))
 
 
   @staticmethod
   def argparser(parser):
     AssembleTask.argparser(parser)
 
+    parser.add_argument('--embed',
+                        dest = 'embed',
+                        action = 'store_true',
+                        default = False,
+                        help = 'embed the initramfs into the kernel instead '
+                               'of creating TARGET.initrd and TARGET.cfg')
+    parser.add_argument('--compression',
+                        dest = 'compression',
+                        metavar = 'FORMAT',
+                        default = 'gzip',
+                        choices = sorted(cpio.COMPRESSORS),
+                        help = 'the compression of the initramfs - one of %s'
+                               % ', '.join(sorted(cpio.COMPRESSORS)))
+    parser.add_argument('--strip',
+                        dest = 'strip',
+                        action = 'store_true',
+                        default = False,
+                        help = 'strip the binaries and modules of all '
+                               'components')
+    parser.add_argument('--modules',
+                        dest = 'modules',
+                        metavar = 'FILE',
+                        default = None,
+                        type = str,
+                        help = 'keep only the kernel modules listed in FILE '
+                               'and their dependencies - FILE lists module '
+                               'names, the output of lsmod collected from the '
+                               'machines or CONFIG_*=m lines of a kernel config')
+    parser.add_argument('--benchmark',
+                        dest = 'benchmark',
+                        metavar = 'RUNS',
+                        default = 0,
+                        type = positive(int),
+                        help = 'boot the image RUNS times in %s without KVM '
+                               'and report the time until the ssh server is '
+                               'ready' % qemu.QEMU)
+    parser.add_argument('--tftp-root',
+                        dest = 'tftp_root',
+                        metavar = 'DIR',
+                        default = '/srv/tftp',
+                        type = str,
+                        help = 'the TFTP root the pxelinux config refers to')
+
     parser.add_argument('target',
                         metavar = 'TARGET',
                         default = 'srv/tftp/maintenance',
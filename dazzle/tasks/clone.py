@@ -1,9 +1,13 @@
 from dazzle.host import HostTask, HostSetMixin, group
-from dazzle.task import Task, JobState, job
+from dazzle.state import host_state
+from dazzle.task import Task, TaskFailed, JobFailed, job
 from dazzle.commands import *
 from dazzle.utils import *
 
 from dazzle.tasks.ctrl import Wakeup, Shutdown
+from dazzle.waves import Waves
+from dazzle.policy import FailurePolicy, FailureTracker, RetryPolicy
+from dazzle.lease import leases
 
 import re
 import threading
@@ -19,13 +23,21 @@ class Acquire(Wakeup):
     if Wakeup.check(self) is None:
       return None
 
-    try:
-      ssh(self.host).cat('/etc/maintenance')
+    maintenance = host_state.get(self.host, 'maintenance')
 
-    except:
-      return None
+    if maintenance is None:
+      try:
+        ssh(self.host).cat('/etc/maintenance')
+
+      except:
+        maintenance = False
+
+      else:
+        maintenance = True
 
-    else:
+      host_state.set(self.host, 'maintenance', maintenance)
+
+    if maintenance:
       return 'Host is already in maintenance mode'
 
 
@@ -45,10 +57,10 @@ class Acquire(Wakeup):
 
     with job(self, 'Enable maintenance config', self.host) as j:
       if not os.path.exists(template):
-        j.status = JobState.Failed('Maintenance TFTP config template is missing: %s' % template)
+        raise TaskFailed('Maintenance TFTP config template is missing: %s' % template)
 
       if os.path.exists(config):
-        j.status = JobState.Failed('Client specific TFTP config file already exists: %s' % config)
+        raise TaskFailed('Client specific TFTP config file already exists: %s' % config)
 
       ln(template,
          config)
@@ -56,12 +68,63 @@ class Acquire(Wakeup):
     try:
       Wakeup.run(self)
 
+      host_state.set(self.host, 'maintenance', True)
+
     finally:
       with job(self, 'Disable maintenance config', self.host) as j:
         rm(config)
 
 
 
+class Lease(HostTask):
+  ''' Lease host in maintenance mode '''
+
+  def __init__(self, parent, host, idle = None, waves = None):
+    HostTask.__init__(self,
+                      parent = parent,
+                      host = host)
+
+    self.__idle = idle
+    self.__waves = waves
+
+
+  @property
+  def pre(self):
+    return Acquire(self,
+                   host = self.host,
+                   waves = self.__waves)
+
+
+  def run(self):
+    leases.acquire(self.host,
+                   idle = self.__idle)
+
+
+  @staticmethod
+  def argparser(parser):
+    parser.add_argument('--idle',
+                        dest = 'idle',
+                        metavar = 'SECONDS',
+                        default = None,
+                        type = int,
+                        help = 'release the hosts after being unused for '
+                               'SECONDS')
+
+    Waves.argparser(parser)
+
+
+
+class Release(Shutdown):
+  ''' Release host from maintenance mode '''
+
+  def check(self):
+    # Drop the lease even if the host is gone already
+    leases.release(self.host)
+
+    return Shutdown.check(self)
+
+
+
 class Receive(HostTask):
   ''' Receive data on host '''
 
@@ -83,12 +146,19 @@ class Receive(HostTask):
   ''', re.VERBOSE)
 
 
-  def __init__(self, parent, host, dst):
+  def __init__(self, parent, host, dst,
+               waves = None,
+               retries = None,
+               backoff = None):
     HostTask.__init__(self,
                       parent = parent,
                       host = host)
 
     self.__dst = dst
+    self.__waves = waves
+
+    self.__retries = retries
+    self.__backoff = backoff
 
     self.__event_ready = threading.Event()
     self.__event_recvy = threading.Event()
@@ -106,8 +176,17 @@ class Receive(HostTask):
 
   @property
   def pre(self):
-    return Acquire(self,
-                   host = self.host)
+    # The transfer itself can't be repeated without the sender but acquiring
+    # the host can
+    acquire = Acquire(self,
+                      host = self.host,
+                      waves = self.__waves)
+
+    RetryPolicy.apply(acquire,
+                      attempts = self.__retries,
+                      delay = self.__backoff)
+
+    return acquire
 
 
   @property
@@ -183,6 +262,8 @@ class Receive(HostTask):
                         type = str,
                         help = 'the device to copy to')
 
+    Waves.argparser(parser)
+
 
 
 class Clone(Task, HostSetMixin):
@@ -200,7 +281,11 @@ class Clone(Task, HostSetMixin):
     $
   ''', re.VERBOSE)
 
-  def __init__(self, parent, hosts, src, dst):
+  def __init__(self, parent, hosts, src, dst,
+               waves = None,
+               on_failure = None,
+               retries = None,
+               backoff = None):
     Task.__init__(self,
                   parent = parent,
                   element = '[%s]' % ', '.join(str(host)
@@ -212,13 +297,42 @@ class Clone(Task, HostSetMixin):
     self.__src = src
     self.__dst = dst
 
+    self.__waves = waves
+
+    self.__on_failure = on_failure
+
+    self.__retries = retries
+    self.__backoff = backoff
+
 
   def run(self):
-    threads = {receiver: threading.Thread(target = receiver)
+    # Learn the state of all hosts in a single pass
+    sweep(self.__hosts)
+
+    # Failed receivers are recorded and left behind according to the policy
+    failures = FailureTracker(policy = self.__on_failure,
+                              total = len(self.__hosts))
+
+    def isolated(receiver):
+      try:
+        receiver()
+
+      except JobFailed:
+        failures.record(receiver)
+
+        # Don't let the sender wait for the failed receiver
+        receiver.event_ready.set()
+        receiver.event_recvy.set()
+
+    threads = {receiver: threading.Thread(target = isolated,
+                                          args = (receiver,))
                for receiver
                in [Receive(parent = self,
                            host = host,
-                           dst = self.__dst)
+                           dst = self.__dst,
+                           waves = self.__waves,
+                           retries = self.__retries,
+                           backoff = self.__backoff)
                    for host
                    in self.__hosts]}
 
@@ -230,9 +344,17 @@ class Clone(Task, HostSetMixin):
     for receiver in threads.iterkeys():
       receiver.event_ready.wait()
 
+    receivers = [receiver
+                 for receiver
+                 in threads.iterkeys()
+                 if receiver not in failures.failed]
+
+    if not receivers:
+      raise TaskFailed(failures.report())
+
     stream = sh.udp_sender('--mcast-rdv-address', '224.0.0.1',
                            '--nokbd',
-                           '--min-receivers', len(threads),
+                           '--min-receivers', len(receivers),
                            '--mcast-data-address', '224.0.0.1',
                            '--max-bitrate', '500m',
                            '--file', self.__src,
@@ -262,6 +384,9 @@ class Clone(Task, HostSetMixin):
     for receiver in threads.itervalues():
       receiver.join()
 
+    if failures.failed:
+      raise TaskFailed(failures.report())
+
 
   @staticmethod
   def argparser(parser):
@@ -278,9 +403,14 @@ class Clone(Task, HostSetMixin):
                         type = str,
                         help = 'the device to copy to')
 
+    Waves.argparser(parser)
+    FailurePolicy.argparser(parser)
+    RetryPolicy.argparser(parser)
     HostSetMixin.argparser(parser)
 
 
 
 AcquireGroup = group(Acquire)
+LeaseGroup = group(Lease)
+ReleaseGroup = group(Release)
 ReceiveGroup = group(Receive)
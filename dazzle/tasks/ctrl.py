@@ -1,42 +1,52 @@
 from dazzle.host import HostTask, group
-from dazzle.task import JobState
+from dazzle.state import host_state
+from dazzle.task import TaskFailed
+from dazzle.engine import AsyncTask, Return, ProcessError
+from dazzle.policy import RetryPolicy
+from dazzle.wol import get_waker
+from dazzle.routes import get_route_table
+from dazzle.waves import Waves
+from dazzle.sshpool import ssh_pool
+from dazzle.ready import ready_listener
+from dazzle.lease import leases
+
+from dazzle import engine
 
 from dazzle.utils import *
 from dazzle.commands import *
 
+import collections
+import hashlib
+import humanize
 import time
-import re
+
+
+
+class WakeupTimeout(TaskFailed):
+  pass
 
 
 
 class Wakeup(HostTask):
   ''' Waking up host '''
 
-  ip_route_get_re = re.compile(r'''
-    ^
-    (?P<dst>
-      ([\d\.]+)
-    )
-    \ +dev\ +(?P<dev>
-      (\w+)
-    )
-    \ +src \ +(?P<src>
-      ([\d\.]+)
-    )
-    $
-  ''', re.VERBOSE)
-
-
-  def __init__(self, parent, host):
+  # Lost wake up packets and slow boots are retried with fresh packets
+  retry = RetryPolicy(attempts = 3,
+                      delay = 5.0,
+                      exceptions = (WakeupTimeout,))
+
+  def __init__(self, parent, host, waves = None):
     HostTask.__init__(self,
                       parent = parent,
                       host = host)
 
-    try:
-      self.__etherwake = sh.etherwake
+    self.__waves = waves
+    self.__wave = None
+
 
-    except:
-      self.__etherwake = sh.ether_wake
+  @property
+  def waves(self):
+    return self.__waves
 
 
   def check(self):
@@ -46,82 +56,267 @@ class Wakeup(HostTask):
 
   def run(self):
     # Find the interface to send the wake up packet from
-    for line in sh.ip.route.get(self.host.l3addr):
-      route = self.ip_route_get_re.match(line.strip())
+    route = get_route_table().lookup(self.host.l3addr)
 
-      if route and route.group('dst') == self.host.l3addr:
-        device = route.group('dev')
-        break
+    if route is None:
+      raise TaskFailed('Can\'t find interface for host: %s' % self.host.l3addr)
 
-    else:
-      self.state = JobState.Failed('Can\'t find interface for host: %s' % self.host.l3addr)
+    device = route.device
 
+    # Wait for the wave of the host to start - retries don't queue up again
+    joined = self.waves is not None and self.__wave is None
 
-    # Try 120 times to wake the host up
-    for x in xrange(0, 120):
-      # Update task's progress
-      self.progress = 'Poke %02d / 120' % (x + 1)
+    if joined:
+      self.__wave = self.waves.join()
 
-      # Send out wake up packets
-      self.__etherwake(self.host.l2addr,
-                       '-i', device)
+      self.progress = 'Waiting for wave %d' % (self.__wave + 1)
+      self.waves.wait(self.__wave)
 
-      # Check if the host is up
-      if ping(self.host,
-              timeout = 1):
-        break
+    # Hosts booting the maintenance image announce themselves as soon as they
+    # are ready - polling remains as fallback for all other systems but can
+    # be done less often
+    announced = ready_listener.listen()
+    started = time.time()
+
+    if announced:
+      pokes, interval = 10, 3.0
 
     else:
-      self.state = JobState.Failed('Host does not wake up in time')
+      pokes, interval = 40, 0.0
+
+    # Let the waker send out wake up packets until the host is up - the
+    # packets for all hosts on the interface are sent in one burst
+    waker = get_waker()
+    waker.add(device, self.host.l2addr)
+
+    try:
+      # Try to wake the host up for a while - the retry policy decides about
+      # further attempts
+      for x in xrange(0, pokes):
+        # Update task's progress
+        self.progress = 'Poke %02d / %02d' % (x + 1, pokes)
+
+        # Wait for the host to announce itself
+        if announced and ready_listener.wait(self.host,
+                                             timeout = interval,
+                                             since = started):
+          host_state.set(self.host, 'alive', True)
+          host_state.set(self.host, 'maintenance', True)
+          break
+
+        # Check if the host is up
+        if ping(self.host,
+                timeout = 1,
+                cached = False):
+          break
+
+      else:
+        raise WakeupTimeout('Host does not wake up in time')
+
+    finally:
+      waker.remove(device, self.host.l2addr)
 
+      if joined:
+        self.waves.finish(self.__wave)
 
 
-class Shutdown(HostTask):
+  @staticmethod
+  def argparser(parser):
+    Waves.argparser(parser)
+
+
+
+class Shutdown(HostTask, AsyncTask):
   ''' Shutting down host '''
 
 
   def check(self):
-    if not ping(self.host):
-      return 'Host is already down'
+    if not (yield engine.ping(self.host)):
+      raise Return('Host is already down')
 
 
   def run(self):
-    ssh(self.host).poweroff(_ok_code = [0, 255])
+    yield engine.ssh(self.host, 'poweroff',
+                     ok_code = [0, 255])
+
+    yield engine.sleep(5)
+
+    host_state.set(self.host, 'alive', False)
+    host_state.set(self.host, 'maintenance', False)
+
+    ssh_pool.terminate(self.host)
 
-    time.sleep(5)
+    leases.release(self.host)
 
 
 
-class Execute(HostTask):
+class Execute(HostTask, AsyncTask):
   ''' Execute given command on host '''
 
+  # Exit code 255 is reported by ssh itself if the connection failed
+  retry = RetryPolicy(attempts = 3,
+                      exit_codes = (255,))
 
-  def __init__(self, parent, host, command):
+  Output = collections.namedtuple('Output', ['digest', 'text', 'size'])
+
+
+  def __init__(self, parent, host, command,
+               stream = False,
+               output_dir = None,
+               buffer_size = 64 * 1024):
     HostTask.__init__(self,
                       parent = parent,
                       host = host)
 
     self.__command = command
 
+    self.__stream = stream
+    self.__output_dir = output_dir
+    self.__buffer_size = buffer_size
+
+    self.__output = None
+
 
   @property
   def command(self):
     return self.__command
 
 
+  @property
+  def output(self):
+    return self.__output
+
+
   def check(self):
-    if not ping(self.host):
-      return 'Host is not reachable'
+    if not (yield engine.ping(self.host)):
+      raise Return('Host is not reachable')
 
 
   def run(self):
+    try:
+      result = yield self.__execute()
+
+    except ProcessError as e:
+      # Don't reuse a broken master connection for the next attempt
+      if e.exit_code == 255:
+        ssh_pool.invalidate(self.host)
+
+      raise
+
+    raise Return(result)
+
+
+  def __execute(self):
     self.progress = self.command
 
-    return ssh(self.host)(self.command)
+    if not (self.__stream or self.__output_dir):
+      result = yield engine.ssh(self.host, self.command,
+                                limit = self.__buffer_size)
+
+      raise Return(result.stdout)
+
+    # Keep only the head of the output in memory but hash all of it to detect
+    # identical outputs of different hosts
+    digest = hashlib.sha1()
+    chunks = []
+
+    # Cells updated by the output callback
+    received = [0]
+    last_update = [0.0]
+
+    if self.__output_dir is not None:
+      output_file = open(os.path.join(self.__output_dir,
+                                      '%s.out' % self.host.label), 'wb')
+
+    else:
+      output_file = None
+
+    def out(chunk):
+      digest.update(chunk)
+
+      if received[0] < self.__buffer_size:
+        chunks.append(chunk[:self.__buffer_size - received[0]])
+
+      received[0] += len(chunk)
+
+      if output_file is not None:
+        output_file.write(chunk)
+
+      # Limit the progress updates to keep the terminal responsive
+      now = time.time()
+      if now - last_update[0] > 0.5:
+        last_update[0] = now
+        self.progress = '%s (%s)' % (self.command,
+                                     humanize.naturalsize(received[0],
+                                                          binary = True))
+
+    try:
+      yield engine.ssh(self.host, self.command,
+                       out = out,
+                       limit = self.__buffer_size)
+
+    finally:
+      if output_file is not None:
+        output_file.close()
+
+    # Only streamed outputs are folded by the summary - others are reported
+    # with the result of the task
+    if not self.__stream:
+      raise Return(''.join(chunks))
+
+    self.__output = self.Output(digest = digest.hexdigest(),
+                                text = ''.join(chunks),
+                                size = received[0])
+
+
+  @staticmethod
+  def summarize(tasks):
+    # Fold identical outputs of all hosts into one block per output
+    outputs = collections.OrderedDict()
+
+    for task in tasks:
+      if task.output is None:
+        continue
+
+      outputs.setdefault(task.output.digest, (task.output, []))[1].append(task.host.label)
+
+    if not outputs:
+      return None
+
+    blocks = []
+    for output, hosts in outputs.itervalues():
+      blocks.append('=== %d host(s): %s' % (len(hosts),
+                                              ', '.join(hosts)))
+
+      blocks.append(output.text.rstrip('\n'))
+
+      if output.size > len(output.text):
+        blocks.append('... (%s total)' % humanize.naturalsize(output.size,
+                                                              binary = True))
+
+    return '\n'.join(blocks)
 
 
   @staticmethod
   def argparser(parser):
+    parser.add_argument('--stream',
+                        dest = 'stream',
+                        action = 'store_true',
+                        default = False,
+                        help = 'stream the output and fold identical outputs '
+                               'of all hosts')
+    parser.add_argument('--output-dir',
+                        dest = 'output_dir',
+                        metavar = 'DIR',
+                        default = None,
+                        type = str,
+                        help = 'write the output of each host to a file in DIR')
+    parser.add_argument('--buffer-size',
+                        dest = 'buffer_size',
+                        metavar = 'BYTES',
+                        default = 64 * 1024,
+                        type = int,
+                        help = 'the amount of output to keep per host')
     parser.add_argument(dest = 'command',
                         metavar = 'COMMAND',
                         type = str,
@@ -1,10 +1,15 @@
 import os
+import argparse
 import contextlib
 
 from os.path import join as mkpath
 
 import sh
 
+from dazzle.prober import get_prober
+from dazzle.state import host_state
+from dazzle.sshpool import ssh_pool, SSH_OPTIONS
+
 
 
 def resource(path):
@@ -14,6 +19,41 @@ def resource(path):
 
 
 
+def cachepath(*path):
+  base = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+  path = mkpath(base, 'dazzle', *path)
+
+  # Ensure the directory containing the requested path exists
+  try:
+    os.makedirs(os.path.dirname(path))
+
+  except OSError:
+    if not os.path.isdir(os.path.dirname(path)):
+      raise
+
+  return path
+
+
+
+def positive(cast):
+  # Returns an argparse type accepting values above zero only
+  def __(value):
+    try:
+      result = cast(value)
+
+    except ValueError:
+      raise argparse.ArgumentTypeError('invalid %s value: %r' % (cast.__name__,
+                                                                 value))
+
+    if result <= 0:
+      raise argparse.ArgumentTypeError('must be greater than zero: %r' % value)
+
+    return result
+
+  return __
+
+
+
 def checkrc(func):
   def __(*args, **kwargs):
     try:
@@ -27,6 +67,24 @@ def checkrc(func):
 
 
 
+@contextlib.contextmanager
+def replacing(path):
+  # Write to a private file and rename it over the target afterwards to avoid
+  # clobbering a file written by a concurrent invocation
+  temp = '%s.%d' % (path, os.getpid())
+
+  try:
+    with open(temp, 'wb') as f:
+      yield f
+
+    os.rename(temp, path)
+
+  finally:
+    if os.path.exists(temp):
+      os.unlink(temp)
+
+
+
 @contextlib.contextmanager
 def cd(new_path):
   old_path = os.getcwd()
@@ -38,19 +96,48 @@ def cd(new_path):
 
 
 
-@checkrc
 def ping(host,
-         timeout = 3):
-  sh.ping('-c', '3',
-          '-i', '0.2',
-          '-w', timeout,
-          host.l3addr)
+         timeout = 3,
+         cached = True):
+  if cached:
+    alive = host_state.get(host, 'alive')
+
+    if alive is not None:
+      return alive
+
+  rtts = get_prober().probe([host.l3addr],
+                            timeout = timeout)
+
+  alive = rtts[host.l3addr] is not None
+  host_state.set(host, 'alive', alive)
+
+  return alive
+
+
+
+def sweep(hosts,
+          timeout = 3):
+  hosts = list(hosts)
+
+  # Probe all hosts in a single pass and map the round trip times back
+  rtts = get_prober().probe([host.l3addr
+                             for host
+                             in hosts],
+                            timeout = timeout)
+
+  rtts = {host : rtts[host.l3addr]
+          for host
+          in hosts}
+
+  for host, rtt in rtts.iteritems():
+    host_state.set(host, 'alive', rtt is not None)
+
+  return rtts
 
 
 
 def ssh(host):
-  return sh.ssh.bake('-o', 'UserKnownHostsFile=/dev/null',
-                     '-o', 'StrictHostKeyChecking=no',
-                     '-o', 'PasswordAuthentication=no',
-                     '-l', 'root',
-                     host.l3addr)
+  # Sessions are multiplexed over a pooled master connection to the host
+  return sh.ssh.bake(*(SSH_OPTIONS +
+                       ssh_pool.options(host) +
+                       [host.l3addr]))
@@ -0,0 +1,129 @@
+import argparse
+import threading
+import time
+
+
+
+class Waves(object):
+  def __init__(self,
+               size,
+               delay = 0.0,
+               ramp = None):
+    assert size > 0
+    assert ramp is None or 0.0 < ramp <= 1.0
+
+    self.__size = size
+    self.__delay = delay
+    self.__ramp = ramp
+
+    self.__joined = 0
+
+    # Number of finished members and opening time per wave
+    self.__finished = []
+    self.__opened = []
+
+    self.__condition = threading.Condition()
+
+
+  @property
+  def size(self):
+    return self.__size
+
+
+  @property
+  def delay(self):
+    return self.__delay
+
+
+  @property
+  def ramp(self):
+    return self.__ramp
+
+
+  def join(self):
+    # Assigns the caller to the next wave with a free slot
+    with self.__condition:
+      wave = self.__joined // self.size
+      self.__joined += 1
+
+      if wave == len(self.__finished):
+        self.__finished.append(0)
+
+      if not self.__opened:
+        self.__opened.append(time.time())
+
+      return wave
+
+
+  def __members(self, wave):
+    return min(self.size, self.__joined - wave * self.size)
+
+
+  def __wait_time(self):
+    # Returns the time until the next wave may open by the delay or None if it
+    # may open now
+    previous = len(self.__opened) - 1
+
+    remaining = self.__opened[previous] + self.delay - time.time()
+    if remaining > 0:
+      return remaining
+
+    if (self.ramp is not None and
+        self.__finished[previous] < self.ramp * self.__members(previous)):
+      return 1.0
+
+    return None
+
+
+  def wait(self, wave):
+    # Blocks until the given wave is opened
+    with self.__condition:
+      while len(self.__opened) <= wave:
+        timeout = self.__wait_time()
+
+        if timeout is None:
+          self.__opened.append(time.time())
+          self.__condition.notify_all()
+
+        else:
+          self.__condition.wait(timeout)
+
+
+  def finish(self, wave):
+    # Marks a member of the wave as up or given up
+    with self.__condition:
+      self.__finished[wave] += 1
+      self.__condition.notify_all()
+
+
+  @staticmethod
+  def parse(value):
+    try:
+      fields = value.split(':')
+
+      size = int(fields[0])
+      delay = float(fields[1]) if len(fields) > 1 and fields[1] else 0.0
+      ramp = float(fields[2]) / 100.0 if len(fields) > 2 and fields[2] else None
+
+      if len(fields) > 3:
+        raise ValueError()
+
+      return Waves(size = size,
+                   delay = delay,
+                   ramp = ramp)
+
+    except (ValueError, AssertionError):
+      raise argparse.ArgumentTypeError('Invalid wave specification: %s' % value)
+
+
+  @staticmethod
+  def argparser(parser):
+    parser.add_argument('--waves',
+                        dest = 'waves',
+                        metavar = 'SIZE[:DELAY[:RAMP]]',
+                        default = None,
+                        type = Waves.parse,
+                        help = 'wake up hosts in waves of SIZE hosts with at '
+                               'least DELAY seconds between waves and wait '
+                               'for RAMP percent of a wave to be up before '
+                               'starting the next one')
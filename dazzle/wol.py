@@ -0,0 +1,172 @@
+import time
+import socket
+import logging
+import binascii
+import threading
+import collections
+
+
+
+ETH_P_WOL = 0x0842
+
+# Socket option to bind a socket to an interface - not exported by Python 2
+SO_BINDTODEVICE = getattr(socket, 'SO_BINDTODEVICE', 25)
+
+
+
+def parse_mac(mac):
+  mac = binascii.unhexlify(mac.replace(':', '').replace('-', ''))
+
+  if len(mac) != 6:
+    raise ValueError('Invalid MAC address: %s' % binascii.hexlify(mac))
+
+  return mac
+
+
+
+def magic_packet(mac):
+  return '\xff' * 6 + parse_mac(mac) * 16
+
+
+
+class Interface(object):
+  def __init__(self, device):
+    self.__device = device
+
+    # Prefer raw ethernet frames like etherwake does and fall back to UDP
+    # broadcasts if the privileges are missing
+    try:
+      self.__socket = socket.socket(socket.AF_PACKET,
+                                    socket.SOCK_RAW,
+                                    socket.htons(ETH_P_WOL))
+      self.__socket.bind((device, ETH_P_WOL))
+
+      self.__mode = 'ethernet'
+      self.__address = self.__socket.getsockname()[4]
+
+    except socket.error as e:
+      logging.debug('Can not open raw socket on %s: %s', device, e)
+
+      self.__socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+      self.__socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+
+      try:
+        self.__socket.setsockopt(socket.SOL_SOCKET, SO_BINDTODEVICE, device + '\0')
+
+      except socket.error as e:
+        logging.debug('Can not bind broadcast socket to %s: %s', device, e)
+
+      self.__mode = 'udp'
+      self.__address = None
+
+
+  @property
+  def device(self):
+    return self.__device
+
+
+  @property
+  def mode(self):
+    return self.__mode
+
+
+  def send(self, macs):
+    # Sends the magic packets for all given MAC addresses in one burst
+    for mac in macs:
+      try:
+        if self.__mode == 'ethernet':
+          self.__socket.send(parse_mac(mac) +
+                             self.__address +
+                             '\x08\x42' +
+                             magic_packet(mac))
+
+        else:
+          self.__socket.sendto(magic_packet(mac), ('255.255.255.255', 9))
+
+      except socket.error as e:
+        logging.debug('Can not send magic packet to %s on %s: %s', mac, self.__device, e)
+
+
+
+class Waker(object):
+  def __init__(self,
+               interval = 1.0,
+               tick = 0.1):
+    self.__interval = interval
+    self.__tick = tick
+
+    self.__interfaces = {}
+
+    # Maps (device, mac) to the time the next packet is due
+    self.__waking = {}
+
+    self.__lock = threading.Condition()
+
+    self.__thread = threading.Thread(target = self.__run)
+    self.__thread.daemon = True
+    self.__thread.start()
+
+
+  def interface(self, device):
+    with self.__lock:
+      if device not in self.__interfaces:
+        self.__interfaces[device] = Interface(device)
+
+      return self.__interfaces[device]
+
+
+  def send(self, device, macs):
+    self.interface(device).send(macs)
+
+
+  def add(self, device, mac):
+    # Pokes the host once per interval until it is removed again - new hosts
+    # are poked with the next tick
+    with self.__lock:
+      self.__waking[(device, mac)] = 0.0
+      self.__lock.notify_all()
+
+
+  def remove(self, device, mac):
+    with self.__lock:
+      self.__waking.pop((device, mac), None)
+
+
+  def __run(self):
+    while True:
+      with self.__lock:
+        while not self.__waking:
+          self.__lock.wait()
+
+        now = time.time()
+
+        # Collect all due hosts per interface
+        bursts = collections.defaultdict(list)
+        for (device, mac), due in self.__waking.items():
+          if due <= now:
+            bursts[device].append(mac)
+            self.__waking[(device, mac)] = now + self.__interval
+
+      for device, macs in bursts.iteritems():
+        try:
+          self.send(device, macs)
+
+        except Exception as e:
+          logging.warn('Can not send wake up packets on %s: %s', device, e)
+
+      time.sleep(self.__tick)
+
+
+
+wakers = []
+wakers_lock = threading.Lock()
+
+
+
+def get_waker():
+  # All tasks of the process share a single waker and its sockets
+  with wakers_lock:
+    if not wakers:
+      wakers.append(Waker())
+
+    return wakers[0]
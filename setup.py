@@ -31,7 +31,7 @@ setuptools.setup(
   install_requires = [
     'blessings >= 1.5.0',
     'enum >= 0.4',
-    'sh >= 1.0',
+    'sh >= 1.12.0',
     'humanize >= 0.5',
     'recordtype >= 1.0'
   ],
@@ -44,6 +44,8 @@ setuptools.setup(
 
       'acquire = dazzle.tasks.clone:AcquireGroup',
       'receive = dazzle.tasks.clone:ReceiveGroup',
+      'lease = dazzle.tasks.clone:LeaseGroup',
+      'release = dazzle.tasks.clone:ReleaseGroup',
 
       'clone = dazzle.tasks.clone:Clone',
 
@@ -0,0 +1,98 @@
+import os
+import shutil
+import hashlib
+import tempfile
+import unittest
+import threading
+import BaseHTTPServer
+
+from dazzle.download import DownloadCache, UnpinnedError, ChecksumError
+
+
+
+CONTENT = 'dazzle' * 4096
+
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+  # Refuses all ranges as if the partial file was complete or bogus
+  def do_GET(self):
+    if self.headers.getheader('Range'):
+      self.send_response(416)
+      self.end_headers()
+      return
+
+    self.send_response(200)
+    self.send_header('Content-Length', str(len(CONTENT)))
+    self.end_headers()
+    self.wfile.write(CONTENT)
+
+
+  def log_message(self, *args):
+    pass
+
+
+
+class DownloadCacheTest(unittest.TestCase):
+  def setUp(self):
+    self.path = tempfile.mkdtemp()
+
+    self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+
+    thread = threading.Thread(target = self.server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    self.url = 'http://127.0.0.1:%d/source.tar.gz' % self.server.server_port
+
+
+  def tearDown(self):
+    self.server.shutdown()
+    self.server.server_close()
+
+    shutil.rmtree(self.path)
+
+
+  def test_unsatisfiable_range(self):
+    cache = DownloadCache(path = self.path,
+                          trust = True)
+
+    with open('%s.part' % cache.path(self.url), 'wb') as f:
+      f.write('stale')
+
+    received = []
+
+    path = cache.fetch(self.url,
+                       sink = received.append)
+
+    with open(path, 'rb') as f:
+      self.assertEqual(f.read(), CONTENT)
+
+    self.assertEqual(''.join(received), CONTENT)
+    self.assertFalse(os.path.exists('%s.part' % path))
+
+
+
+  def test_unpinned(self):
+    cache = DownloadCache(path = self.path)
+
+    self.assertRaises(UnpinnedError, cache.fetch, self.url)
+    self.assertFalse(os.path.exists(cache.path(self.url)))
+
+
+  def test_pinned(self):
+    cache = DownloadCache(path = self.path)
+
+    path = cache.fetch(self.url,
+                       checksum = 'sha256:%s' % hashlib.sha256(CONTENT).hexdigest())
+
+    self.assertTrue(os.path.exists(path))
+
+    self.assertRaises(ChecksumError,
+                      DownloadCache(path = tempfile.mkdtemp(dir = self.path)).fetch,
+                      self.url,
+                      checksum = 'sha256:%s' % ('0' * 64))
+
+
+if __name__ == '__main__':
+  unittest.main()
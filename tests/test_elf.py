@@ -0,0 +1,66 @@
+import os
+import struct
+import tempfile
+import unittest
+
+from dazzle.elf import LdCache, CACHE_MAGIC_OLD, CACHE_MAGIC_NEW
+
+
+
+def compat_cache(entries):
+  # Builds a cache in the format written by glibc before 2.32 - an empty
+  # table of the old format followed by the new one
+  old = CACHE_MAGIC_OLD + '\0' + struct.pack('=I', 0)
+  old += '\0' * (-len(old) % 8)
+
+  strings = ''
+  table = ''
+
+  # String offsets are relative to the header of the new format
+  base = 48 + len(entries) * 24
+
+  for flags, key, value in entries:
+    table += struct.pack('=iIIIQ',
+                         flags,
+                         base + len(strings),
+                         base + len(strings) + len(key) + 1,
+                         0,
+                         0)
+    strings += key + '\0' + value + '\0'
+
+  header = struct.pack('=20sII4sI12s',
+                       CACHE_MAGIC_NEW,
+                       len(entries),
+                       len(strings),
+                       '',
+                       0,
+                       '')
+
+  return old + header + table + strings
+
+
+
+class LdCacheTest(unittest.TestCase):
+  def test_compat_cache(self):
+    fd, path = tempfile.mkstemp()
+
+    try:
+      with os.fdopen(fd, 'wb') as f:
+        f.write(compat_cache([(0x0303, 'libc.so.6', '/lib/x86_64-linux-gnu/libc.so.6'),
+                              (0x0003, 'libc.so.6', '/lib/i386-linux-gnu/libc.so.6')]))
+
+      cache = LdCache(path)
+
+      self.assertEqual(cache.lookup('libc.so.6', (62, 2)),
+                       '/lib/x86_64-linux-gnu/libc.so.6')
+      self.assertEqual(cache.lookup('libc.so.6', (3, 1)),
+                       '/lib/i386-linux-gnu/libc.so.6')
+      self.assertIsNone(cache.lookup('libm.so.6', (62, 2)))
+
+    finally:
+      os.unlink(path)
+
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,117 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from dazzle.index import HostIndex, expand_range
+
+
+
+HOSTS = '''
+[pc009]
+group = lab
+
+[pc010]
+group = lab, linux
+
+[pc011]
+group = lab
+
+[pc020]
+group = linux
+
+[pc021]
+group = lab, linux
+
+[srv1]
+group = server, linux
+'''
+
+
+
+class HostIndexTest(unittest.TestCase):
+  def setUp(self):
+    self.path = tempfile.mkdtemp()
+
+    hosts = os.path.join(self.path, 'hosts')
+    with open(hosts, 'w') as f:
+      f.write(HOSTS)
+
+    self.index = HostIndex.compile(hosts)
+
+
+  def tearDown(self):
+    shutil.rmtree(self.path)
+
+
+  def select(self, selector):
+    bitset = self.index.select(selector)
+
+    return [label
+            for label
+            in self.index.labels
+            if bitset & (1 << self.index.id(label))]
+
+
+  def test_expand_range(self):
+    self.assertEqual(list(expand_range('009-011,020')),
+                     ['009', '010', '011', '020'])
+    self.assertEqual(list(expand_range('9-11')),
+                     ['9', '10', '11'])
+
+    self.assertRaises(ValueError, list, expand_range('a-b'))
+
+
+  def test_labels(self):
+    self.assertEqual(self.select('srv1,pc010'),
+                     ['pc010', 'srv1'])
+
+    self.assertRaises(KeyError, self.index.select, 'pc999')
+
+
+  def test_groups(self):
+    self.assertEqual(self.select('@lab'),
+                     ['pc009', 'pc010', 'pc011', 'pc021'])
+    self.assertEqual(self.select('@'),
+                     self.index.labels)
+
+
+  def test_intersection(self):
+    self.assertEqual(self.select('@lab&@linux'),
+                     ['pc010', 'pc021'])
+    self.assertEqual(self.select('@server & @linux'),
+                     ['srv1'])
+
+
+  def test_zero_padded_range(self):
+    # Labels missing in the range are left out
+    self.assertEqual(self.select('pc[010-020]'),
+                     ['pc010', 'pc011', 'pc020'])
+    self.assertEqual(self.select('pc[009,021]'),
+                     ['pc009', 'pc021'])
+
+
+  def test_removal(self):
+    # A leading removal starts with all hosts
+    self.assertEqual(self.select('-pc[010-020]'),
+                     ['pc009', 'pc021', 'srv1'])
+    self.assertEqual(self.select('@lab,-pc[010-020]'),
+                     ['pc009', 'pc021'])
+    self.assertEqual(self.select('@linux,-@lab&@linux'),
+                     ['pc020', 'srv1'])
+
+
+  def test_unknown_group(self):
+    self.assertEqual(self.select('@unknown'), [])
+    self.assertEqual(self.select('@lab&@unknown'), [])
+    self.assertEqual(self.select('-@unknown'),
+                     self.index.labels)
+
+
+  def test_empty_terms(self):
+    self.assertRaises(ValueError, self.index.select, '@lab,,srv1')
+    self.assertRaises(ValueError, self.index.select, '@lab&')
+
+
+if __name__ == '__main__':
+  unittest.main()
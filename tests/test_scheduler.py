@@ -0,0 +1,127 @@
+import time
+import logging
+import argparse
+import unittest
+import threading
+
+from dazzle.scheduler import Scheduler
+
+
+
+class SchedulerTest(unittest.TestCase):
+  def test_priority(self):
+    # A single worker runs the functions one after another
+    scheduler = Scheduler(concurrency = 1)
+
+    order = []
+    for name, priority in [('a', 0),
+                           ('b', 5),
+                           ('c', 0),
+                           ('d', 5),
+                           ('e', -1)]:
+      scheduler.submit(lambda name = name: order.append(name),
+                       priority = priority)
+
+    scheduler.run()
+
+    self.assertEqual(order, ['b', 'd', 'a', 'c', 'e'])
+
+
+  def test_concurrency(self):
+    scheduler = Scheduler(concurrency = 3)
+
+    lock = threading.Lock()
+    active = [0]
+    peak = [0]
+
+    def func():
+      with lock:
+        active[0] += 1
+        peak[0] = max(peak[0], active[0])
+
+      time.sleep(0.05)
+
+      with lock:
+        active[0] -= 1
+
+    for _ in xrange(10):
+      scheduler.submit(func)
+
+    scheduler.run()
+
+    self.assertEqual(peak[0], 3)
+    self.assertEqual(active[0], 0)
+
+
+  def test_rate(self):
+    scheduler = Scheduler(concurrency = 10,
+                          rate = 20.0)
+
+    starts = []
+    for _ in xrange(5):
+      scheduler.submit(lambda: starts.append(time.time()))
+
+    scheduler.run()
+
+    starts.sort()
+
+    # The starts are spread by 1 / rate seconds
+    self.assertEqual(len(starts), 5)
+    self.assertGreaterEqual(starts[-1] - starts[0], 4 / 20.0 - 0.01)
+
+
+  def test_submit_while_running(self):
+    scheduler = Scheduler(concurrency = 2)
+
+    done = []
+
+    def parent():
+      scheduler.submit(lambda: done.append('child'))
+      done.append('parent')
+
+    scheduler.submit(parent)
+    scheduler.run()
+
+    self.assertEqual(sorted(done), ['child', 'parent'])
+
+
+  def test_failure(self):
+    scheduler = Scheduler(concurrency = 1)
+
+    done = []
+
+    def fail():
+      raise RuntimeError('failed')
+
+    scheduler.submit(fail, priority = 1)
+    scheduler.submit(lambda: done.append(True))
+
+    # Failed functions are logged and do not stop the others
+    logger = logging.getLogger()
+    level = logger.level
+    logger.setLevel(100)
+
+    try:
+      scheduler.run()
+
+    finally:
+      logger.setLevel(level)
+
+    self.assertEqual(done, [True])
+
+
+  def test_argparser(self):
+    parser = argparse.ArgumentParser()
+    Scheduler.argparser(parser)
+
+    args = parser.parse_args(['--parallel', '4', '--rate', '2.5'])
+    self.assertEqual(args.parallel, 4)
+    self.assertEqual(args.rate, 2.5)
+
+    for argv in (['--parallel', '0'],
+                 ['--rate', '-1']):
+      self.assertRaises(SystemExit, parser.parse_args, argv)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,94 @@
+import os
+import shutil
+import tempfile
+import unittest
+import collections
+
+from dazzle.sshpool import ConnectionPool
+
+
+
+Host = collections.namedtuple('Host', ['l3addr'])
+
+
+
+class ConnectionPoolTest(unittest.TestCase):
+  def setUp(self):
+    # Record the invocations of ssh instead of connecting anywhere
+    self.path = tempfile.mkdtemp()
+    self.calls = os.path.join(self.path, 'calls')
+
+    with open(os.path.join(self.path, 'ssh'), 'w') as f:
+      f.write('#!/bin/sh\necho "$@" >> %s\n' % self.calls)
+
+    os.chmod(os.path.join(self.path, 'ssh'), 0755)
+
+    self.environ = os.environ['PATH']
+    os.environ['PATH'] = '%s:%s' % (self.path, self.environ)
+
+    self.pool = ConnectionPool()
+
+
+  def tearDown(self):
+    self.pool.close()
+
+    os.environ['PATH'] = self.environ
+    shutil.rmtree(self.path)
+
+
+  def commands(self):
+    if not os.path.exists(self.calls):
+      return []
+
+    with open(self.calls, 'r') as f:
+      return [line.split() for line in f]
+
+
+  def control(self, options):
+    return options[options.index('-o', 2) + 1]
+
+
+  def test_terminate_stops_master(self):
+    host = Host(l3addr = '192.0.2.1')
+
+    control = self.control(self.pool.options(host))
+
+    self.pool.terminate(host)
+
+    stop = self.commands()[-1]
+
+    self.assertIn(control, stop)
+    self.assertEqual(stop[stop.index('-O') + 1], 'exit')
+
+
+  def test_invalidate_keeps_sessions(self):
+    host = Host(l3addr = '192.0.2.1')
+
+    control = self.control(self.pool.options(host))
+
+    self.pool.invalidate(host)
+
+    # Sessions over the forgotten master are left alone and the next master
+    # uses a control path of its own
+    self.assertNotIn('-O', sum(self.commands(), []))
+    self.assertNotEqual(self.control(self.pool.options(host)), control)
+
+
+  def test_expired_master_is_left_alone(self):
+    self.pool.idle = 0
+
+    self.pool.options(Host(l3addr = '192.0.2.1'))
+    self.pool.options(Host(l3addr = '192.0.2.2'))
+
+    self.assertNotIn('-O', sum(self.commands(), []))
+
+
+  def test_invalidate_unknown_host(self):
+    self.pool.invalidate(Host(l3addr = '192.0.2.2'))
+
+    self.assertEqual(self.commands(), [])
+
+
+
+if __name__ == '__main__':
+  unittest.main()